@@ -2,21 +2,27 @@
 LangChain agent for food delivery app chatbot with simplified global memory and image understanding
 """
 import asyncio
-import json
+import functools
+import importlib
+import itertools
+import logging
+import re
 import time
-from typing import Dict, Any, List, Optional, AsyncGenerator
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, AsyncGenerator, Iterator, Tuple
 
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain.agents import AgentExecutor, create_tool_calling_agent
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
 from .client import BedrockClientSetup
+from .cache import LLMCache, ResponseCache
+from .context import CURRENT_CONVERSATION_ID, CURRENT_IMAGE
 from .memory import ConversationMemoryManager
-from .tools.order_tools import get_order_details, initiate_refund, get_refund_details
-from .tools.search_tools import search_restaurants, search_restaurants_direct, search_food_items_enhanced, get_restaurant_menu
-from .tools.image_verification_tools import verify_refund_image, get_refund_verification_criteria, create_refund_workflow, update_refund_workflow, get_refund_workflow_state, process_refund_decision
-from .tools.document_analysis_tools import analyze_medical_document
-from .callbacks import StreamingToolsCallbackHandler, EnhancedStreamingHandler
+from .callbacks import StreamingToolsCallbackHandler, EnhancedStreamingHandler, RepeatedToolCallError, ToolLoopGuardHandler
+
+# Set up logging
+logger = logging.getLogger(__name__)
 
 
 # Helper functions for multi-tool orchestration
@@ -25,100 +31,109 @@ def extract_restaurant_ids_from_food_results(results: Dict[str, Any]) -> List[st
     if not results or "results" not in results:
         return []
     
-    restaurant_ids = set()
-    for item in results.get("results", []):
-        if isinstance(item, dict) and "data" in item:
-            rest_id = item["data"].get("restaurant_id")
-            if rest_id:
-                restaurant_ids.add(rest_id)
-    
-    return list(restaurant_ids)
+    # Dict keys dedupe while keeping first-seen order, so the same results
+    # always produce the same ID list
+    return list({
+        rest_id: None
+        for item in results["results"]
+        if isinstance(item, dict) and "data" in item and (rest_id := item["data"].get("restaurant_id"))
+    })
 
 def format_results_for_next_step(results: Dict[str, Any], result_type: str) -> str:
     """Format results for use in a follow-up tool call"""
     if result_type == "food_items" and "results" in results:
+        # Group food items by restaurant, keeping the order restaurants first appear in
         restaurants = {}
-        # Group food items by restaurant
-        for item in results.get("results", []):
+        for item in results["results"]:
             if "data" in item:
-                rest_id = item["data"].get("restaurant_id")
-                rest_name = item["data"].get("restaurant_name", "Unknown")
-                if rest_id not in restaurants:
-                    restaurants[rest_id] = {"name": rest_name, "items": []}
-                restaurants[rest_id]["items"].append(item["data"].get("name"))
+                data = item["data"]
+                rest_id = data.get("restaurant_id")
+                group = restaurants.get(rest_id)
+                if group is None:
+                    group = restaurants[rest_id] = (data.get("restaurant_name", "Unknown"), [])
+                group[1].append(data.get("name"))
         
         # Format for LLM consumption
-        result_str = "Found food items at these restaurants:\n"
-        for rest_id, data in restaurants.items():
-            items_str = ", ".join(data["items"])
-            result_str += f"- {data['name']} (ID: {rest_id}): {items_str}\n"
-        
-        return result_str
+        lines = ["Found food items at these restaurants:"]
+        lines.extend(
+            f"- {rest_name} (ID: {rest_id}): {', '.join(items)}"
+            for rest_id, (rest_name, items) in restaurants.items()
+        )
+        return "\n".join(lines) + "\n"
     
     return str(results)
 
 
-class ChatbotAgent:
-    """LangChain agent implementation for food delivery chatbot"""
+# Keywords that mark a message as a question about the conversation history,
+# matched as case-insensitive substrings in a single scan
+_MEMORY_QUERY_RE = re.compile(
+    r"what did i ask|previous|earlier|first question|remember|summarize|conversation|chat history",
+    re.IGNORECASE
+)
+
+# Notes attached after the user's message when an image is uploaded
+_IMAGE_REFUND_NOTE = HumanMessage(
+    content="I've uploaded an image to verify my refund request. Please analyze it carefully."
+)
+_IMAGE_UPLOAD_NOTE = HumanMessage(content="I've uploaded an image for you to analyze.")
+
+# Stream queue priorities: structured data cards are delivered ahead of regular
+# events, and the completion sentinel sorts behind everything still pending
+_PRIORITY_STRUCTURED = 0
+_PRIORITY_EVENT = 1
+_PRIORITY_DONE = 2
+
+# Internal event type carrying all structured data cards from one tool result
+_STRUCTURED_BATCH = "structured_data_batch"
+
+# Constant opening event of every streamed response. Shared, so it must not be
+# mutated (a plain dict rather than a MappingProxyType, which orjson can't serialize)
+_THINKING_EVENT = {"type": "thinking", "data": "Analyzing your request..."}
+
+# Bound on events buffered between the agent task and the client; a slow client
+# makes the agent's callbacks wait instead of letting the buffer grow unchecked
+_STREAM_QUEUE_SIZE = 32
+
+# Prefix of the output AgentExecutor returns when it hits its iteration or time limit
+_EARLY_STOP_PREFIX = "Agent stopped due to"
+
+# Location used when the client doesn't send one (central Bengaluru)
+DEFAULT_LATITUDE = 12.9716
+DEFAULT_LONGITUDE = 77.5946
+
+
+@dataclass(frozen=True, slots=True)
+class RequestContext:
+    """Per-request inputs parsed once from the raw location and media payloads"""
+    latitude: float
+    longitude: float
+    image_data: Optional[str] = None
+    image_name: Optional[str] = None
+
+
+def _parse_request(location: Optional[Dict[str, float]], media: Optional[Dict[str, Any]]) -> RequestContext:
+    """Parse the location and media payloads of a chat request into a RequestContext"""
+    if location:
+        latitude = location.get("latitude", DEFAULT_LATITUDE)
+        longitude = location.get("longitude", DEFAULT_LONGITUDE)
+    else:
+        latitude, longitude = DEFAULT_LATITUDE, DEFAULT_LONGITUDE
     
-    def __init__(self):
-        """Initialize the chatbot agent with LLM, tools, and memory"""
-        # Initialize Bedrock client and LLM
-        self.llm = BedrockClientSetup.get_llm()
-        self.prompt = self._get_enhanced_prompt_template()
-        
-        # Define the tools
-        self.tools = [
-            # Order and refund tools
-            get_order_details,
-            initiate_refund,
-            get_refund_details,
-            
-            # Search tools
-            search_restaurants,
-            search_restaurants_direct,
-            search_food_items_enhanced,
-            get_restaurant_menu,
-            
-            # Image verification and refund workflow tools
-            verify_refund_image,
-            get_refund_verification_criteria,
-            create_refund_workflow,
-            update_refund_workflow,
-            get_refund_workflow_state,
-            process_refund_decision,
-            
-            # Document analysis tools
-            analyze_medical_document
-        ]
-        
-        # Initialize the memory manager (needed for image processing)
-        self.memory_manager = ConversationMemoryManager(window_size=10)
-        
-        # Create the tool calling agent (no memory - we use frontend history instead)
-        self.agent = create_tool_calling_agent(
-            llm=self.llm,
-            tools=self.tools,
-            prompt=self.prompt
-        )
-        
-        # Create a single agent executor (memory-free version)
-        self.agent_executor = AgentExecutor(
-            agent=self.agent,
-            tools=self.tools,
-            verbose=True,
-            memory=None,  # No memory - history comes from frontend now
-            handle_parsing_errors=True,
-            max_iterations=500,
-            max_execution_time=120
-        )
+    if not media or media.get("type") != "image" or not media.get("data"):
+        return RequestContext(latitude, longitude)
     
-    def _get_enhanced_prompt_template(self) -> ChatPromptTemplate:
-        """Create an enhanced prompt template that encourages multi-step reasoning"""
-        from langchain_core.prompts import MessagesPlaceholder
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful assistant for a food delivery app.
+    image_metadata = media.get("metadata") or {}
+    return RequestContext(
+        latitude,
+        longitude,
+        image_data=media["data"],
+        image_name=image_metadata.get("name", "uploaded image")
+    )
+
+
+# System prompt for the food delivery agent. Kept free of per-request content
+# so the prefix stays byte-identical across turns and can be prompt-cached.
+SYSTEM_PROMPT = """You are a helpful assistant for a food delivery app.
 
 For complex user requests, break down your thinking into multiple steps and use different tools sequentially.
 Express your reasoning in short, clear sentences before using each tool.
@@ -143,11 +158,17 @@ STEP-BY-STEP REASONING PROCESS:
 4. Think about what additional information you need after each step
 5. Synthesize information from all tool results to provide a complete response
 
+PARALLEL TOOL CALLS:
+- When several tool calls do not depend on each other's results, request them ALL in the same step
+- Examples: looking up an order while searching restaurants, or fetching menus for several restaurant IDs you already have
+- Only wait for a result first when the next call needs a value from it (e.g. a restaurant_id from a search)
+
 IMPORTANT TOOL SELECTION GUIDELINES:
 - For restaurants or places to eat → use 'search_restaurants' tool
 - For specific restaurants by name → use 'search_restaurants_direct' tool
 - For specific food items or dishes → use 'search_food_items_enhanced' tool (this efficiently searches across restaurants)
 - For restaurant menus → use 'get_restaurant_menu' tool (requires restaurant_id)
+- For menus of several restaurants whose IDs you already have → use 'get_restaurant_menus_bulk' tool in one call instead of repeated 'get_restaurant_menu' calls
 - For order details → use 'get_order_details' tool
 - For refund requests → use 'initiate_refund' tool
 
@@ -156,27 +177,11 @@ PREVENTING SEARCH LOOPS:
 - DO NOT attempt multiple searches for the same food item with different wordings
 - The search_food_items_enhanced tool already performs comprehensive searches across restaurants and cuisines
 
-CHAT HISTORY FORMAT:
-- Each user message will include a <chat_history> tag with up to 6 recent messages
-- The format will be:
-  User: [previous user message]
-  Assistant: [previous assistant response]
-- Use this context to maintain conversation continuity
-- Pay special attention to questions about previous messages or references
-- When asked about previous messages, refer to this chat history context
-
-CONVERSATION MEMORY GUIDELINES:
-- You have access to the last 10 messages exchanged in this conversation
-- Always reference this chat history when the user asks about previous messages
-- When asked about past queries or conversations, DO NOT say "this is the beginning of our conversation"
-- If the user asks what they asked earlier or wants a summary, refer to the actual previous messages
-- For questions like "what was my first question?", look at the chat history and respond appropriately
-- Examples of memory-related queries you should handle correctly:
-  * "What did I ask you earlier?"
-  * "Summarize our conversation"
-  * "What was my first question?"
-  * "What have we talked about so far?"
-  * "Can you remember what I ordered?"
+CHAT HISTORY:
+- User messages may end with a <chat_history> tag holding the most recent exchanges as "User: ..." / "Assistant: ..." lines
+- Use it to keep the conversation continuous and to answer questions about earlier messages
+  (e.g. "What did I ask earlier?", "Summarize our conversation", "What was my first question?")
+- When chat history is present, DO NOT say "this is the beginning of our conversation"
 
 IMAGE ANALYSIS CAPABILITIES:
 - You can see and analyze images that users upload
@@ -252,26 +257,311 @@ RESPONSE FORMAT:
 
 CRITICAL SPECIAL DATA FORMAT:
 When presenting structured data like restaurants, food items, orders, or refunds, you MUST use the special format below:
-- For restaurants: :::restaurant{{"name":"Restaurant Name", "rating":4.5, "cuisines":["Italian", "Pizza"], "delivery_time":"30 mins", "price_range":"$$$", "image_url":"cloudinaryImageId-or-full-url"}}:::
-- For food items: :::food_item{{"name":"Food Name", "price":10.99, "description":"Description text", "restaurant_name":"Restaurant Name", "image_url":"imageId-or-full-url"}}:::
-- For order details: :::order_details{{"order_id":"12345", "status":"delivered", "items":[{{"name":"Food Item", "quantity":2, "price":10.99}}], "total_price":21.98}}:::
-- For refund status: :::refund_status{{"order_id":"12345", "status":"approved", "amount":21.98, "reason":"Food was cold", "timestamp":"2025-03-09T22:59:54.243015"}}:::
+- For restaurants: :::restaurant{"name":"Restaurant Name", "rating":4.5, "cuisines":["Italian", "Pizza"], "delivery_time":"30 mins", "price_range":"$$$", "image_url":"cloudinaryImageId-or-full-url"}:::
+- For food items: :::food_item{"name":"Food Name", "price":10.99, "description":"Description text", "restaurant_name":"Restaurant Name", "image_url":"imageId-or-full-url"}:::
+- For order details: :::order_details{"order_id":"12345", "status":"delivered", "items":[{"name":"Food Item", "quantity":2, "price":10.99}], "total_price":21.98}:::
+- For refund status: :::refund_status{"order_id":"12345", "status":"approved", "amount":21.98, "reason":"Food was cold", "timestamp":"2025-03-09T22:59:54.243015"}:::
 
 Example structured response:
 "Here's the restaurant I found for you:
 
-:::restaurant{{"name":"Pizza Palace", "rating":4.8, "cuisines":["Italian", "Pizza"], "delivery_time":"25 mins", "image_url":"c8c462d2-96a4-4579-87cb-696459cf6624"}}:::
+:::restaurant{"name":"Pizza Palace", "rating":4.8, "cuisines":["Italian", "Pizza"], "delivery_time":"25 mins", "image_url":"c8c462d2-96a4-4579-87cb-696459cf6624"}:::
 
 They have many great options on their menu. Here's one of their popular items:
 
-:::food_item{{"name":"Margherita Pizza", "price":12.99, "description":"Classic pizza with tomato sauce, mozzarella, and basil", "restaurant_name":"Pizza Palace", "image_url":"e33e1c96-0f9c-4468-b38e-5986c8599cmb"}}:::"
-
-CRITICAL: Always use this exact format for displaying restaurants, food items, and orders.
+:::food_item{"name":"Margherita Pizza", "price":12.99, "description":"Classic pizza with tomato sauce, mozzarella, and basil", "restaurant_name":"Pizza Palace", "image_url":"e33e1c96-0f9c-4468-b38e-5986c8599cmb"}:::"
 
 Always respond conversationally and be helpful to the user.
 Remember the context of previous messages in the conversation.
-"""),
+"""
+
+
+def _build_system_message() -> SystemMessage:
+    """Build the system message, marked as a Bedrock prompt-cache point when supported
+    
+    Older langchain-aws releases reject list-valued system content or drop
+    cache_control, so the installed formatter is checked once and a plain
+    string prompt is used if the cache point wouldn't reach Bedrock.
+    """
+    cached_message = SystemMessage(content=[{
+        "type": "text",
+        "text": SYSTEM_PROMPT,
+        # Static prefix (tool definitions + system prompt) is cached by Bedrock
+        "cache_control": {"type": "ephemeral"}
+    }])
+    
+    try:
+        from langchain_aws.chat_models.bedrock import _format_anthropic_messages
+        system, _ = _format_anthropic_messages([cached_message])
+    except Exception as e:
+        logger.info("Bedrock prompt caching unavailable (%s); using a plain system prompt", e)
+        return SystemMessage(content=SYSTEM_PROMPT)
+    
+    if not isinstance(system, list) or not any(
+        isinstance(block, dict) and "cache_control" in block for block in system
+    ):
+        logger.info("Installed langchain-aws drops cache_control; using a plain system prompt")
+        return SystemMessage(content=SYSTEM_PROMPT)
+    
+    return cached_message
+
+
+# Structured data extraction: tool outputs are fingerprinted by the keys they
+# carry and dispatched to a handler in a single pass (see _extract_structured_data)
+_DISCRIMINATOR_KEYS = frozenset({
+    "type", "data", "restaurant_info", "results", "menu", "order_id", "items", "status",
+    "refund_status", "refund", "verification_score", "verification_status", "workflow_id",
+    "current_stage", "document_type",
+})
+# Pseudo-keys added to a signature for facts that aren't plain key presence
+_SIG_DOCUMENT_RESULT = "@document_analysis_result"  # output["type"] == "document_analysis_result"
+_SIG_WORKFLOW_TOOL = "@workflow_tool"
+_SIG_DOCUMENT_TOOL = "@document_tool"
+
+_WORKFLOW_TOOLS = frozenset({"create_refund_workflow", "update_refund_workflow", "get_refund_workflow_state"})
+
+# Keys that mark an untyped search result as a dish or a restaurant
+_FOOD_SIGNATURE = frozenset({"price", "description"})
+_RESTAURANT_SIGNATURE = frozenset({"rating", "cuisines"})
+
+
+def _extract_direct(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 1: Direct structured data"""
+    return [output]
+
+
+def _extract_restaurant_info(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 2: Restaurant info from get_restaurant_menu"""
+    structured_data = [{"type": "restaurant", "data": output["restaurant_info"]}]
+    
+    # Also check for any food items
+    featured_items = output.get("featured_items")
+    if isinstance(featured_items, list):
+        rest_name = output.get("restaurant_name", "Restaurant")
+        rest_id = output.get("restaurant_id", "unknown")
+        for item in itertools.islice(featured_items, 5):  # Limit to 5 items
+            data = item.copy()
+            data["restaurant_name"] = rest_name
+            data["restaurant_id"] = rest_id
+            structured_data.append({"type": "food_item", "data": data})
+    return structured_data
+
+
+def _extract_results(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 3: Results array with structured data"""
+    results = output["results"]
+    if not isinstance(results, list):
+        return None
+    
+    structured_data = []
+    for item in itertools.islice(results, 10):  # Limit to 10 items
+        if not isinstance(item, dict):
+            continue
+        # Already has type/data format
+        if "type" in item and "data" in item:
+            structured_data.append(item)
+        # Try to infer type from properties
+        elif "name" in item:
+            keys = item.keys()
+            if not _FOOD_SIGNATURE.isdisjoint(keys):
+                structured_data.append({"type": "food_item", "data": item})
+            elif not _RESTAURANT_SIGNATURE.isdisjoint(keys):
+                structured_data.append({"type": "restaurant", "data": item})
+    return structured_data
+
+
+def _extract_menu(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 4: Menu array"""
+    menu = output["menu"]
+    if not isinstance(menu, list):
+        return None
+    
+    # First add restaurant info if available
+    rest_name = output.get("restaurant_name", "Restaurant")
+    rest_id = output.get("restaurant_id", "unknown")
+    structured_data = [{
+        "type": "restaurant",
+        "data": {
+            "name": rest_name,
+            "id": rest_id,
+            "cuisines": output.get("cuisines", []),
+            "rating": output.get("rating", "N/A")
+        }
+    }]
+    
+    # Up to 3 items per category and 10 overall; islice stops the walk as soon
+    # as the overall limit is reached, however large the menu is
+    menu_items = (
+        (category.get("category", ""), item)
+        for category in menu
+        if isinstance(category.get("items"), list)
+        for item in itertools.islice(category["items"], 3)
+    )
+    for category_name, item in itertools.islice(menu_items, 10):
+        data = item.copy()
+        data["restaurant_name"] = rest_name
+        data["restaurant_id"] = rest_id
+        data["category"] = category_name
+        structured_data.append({"type": "food_item", "data": data})
+    return structured_data
+
+
+def _extract_order_details(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 5: Special case for order details"""
+    if "type" in output:
+        return []
+    # Infer order_details type
+    return [{"type": "order_details", "data": output}]
+
+
+def _extract_refund_status(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 6: Refund status"""
+    if "type" in output:
+        return []
+    # Infer refund_status type
+    return [{"type": "refund_status", "data": output}]
+
+
+def _extract_image_verification(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 7: Image verification result"""
+    return [{"type": "image_verification_result", "data": output}]
+
+
+def _extract_workflow_state(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 8: Refund workflow state"""
+    return [{"type": "refund_workflow_state", "data": output}]
+
+
+def _extract_document_analysis(output: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Case 9: Document analysis result"""
+    # Ensure we're passing the data in the right format
+    if output.get("type") == "document_analysis_result" and "data" in output:
+        return [output]
+    return [{"type": "document_analysis_result", "data": output}]
+
+
+# Ordered (alternative signatures, handler) table. Handlers whose signature is
+# contained in the output's signature apply in table order; a handler returning
+# None declines (e.g. "results" is not a list) and dispatch moves on.
+_EXTRACT_HANDLERS = (
+    ((frozenset({"type", "data"}),), _extract_direct),
+    ((frozenset({"restaurant_info"}),), _extract_restaurant_info),
+    ((frozenset({"results"}),), _extract_results),
+    ((frozenset({"menu"}),), _extract_menu),
+    ((frozenset({"order_id", "items"}), frozenset({"order_id", "status"})), _extract_order_details),
+    ((frozenset({"refund_status"}), frozenset({"refund", "status"})), _extract_refund_status),
+    ((frozenset({"verification_score"}), frozenset({"verification_status"})), _extract_image_verification),
+    ((frozenset({_SIG_WORKFLOW_TOOL, "status", "workflow_id"}),
+      frozenset({_SIG_WORKFLOW_TOOL, "current_stage"})), _extract_workflow_state),
+    ((frozenset({_SIG_DOCUMENT_TOOL}), frozenset({"document_type"}), frozenset({_SIG_DOCUMENT_RESULT})),
+     _extract_document_analysis),
+)
+
+
+@functools.lru_cache(maxsize=256)
+def _handlers_for(signature: frozenset) -> Tuple:
+    """Handlers applicable to an output signature, in dispatch order (memoized per signature)"""
+    return tuple(
+        handler
+        for signatures, handler in _EXTRACT_HANDLERS
+        if any(required <= signature for required in signatures)
+    )
+
+
+# Tools available to the agent, as (module, tool names) pairs. The tool modules
+# pull in pymongo, the Swiggy client and pydantic schemas, so they are imported
+# when the agent is first built rather than when this module is imported.
+_TOOL_SPECS = (
+    # Order and refund tools
+    (".tools.order_tools", ("get_order_details", "initiate_refund", "get_refund_details")),
+    
+    # Search tools
+    (".tools.search_tools", ("search_restaurants", "search_restaurants_direct", "search_food_items_enhanced",
+                             "get_restaurant_menu", "get_restaurant_menus_bulk")),
+    
+    # Image verification and refund workflow tools
+    (".tools.image_verification_tools", ("verify_refund_image", "get_refund_verification_criteria",
+                                         "create_refund_workflow", "update_refund_workflow",
+                                         "get_refund_workflow_state", "process_refund_decision")),
+    
+    # Document analysis tools
+    (".tools.document_analysis_tools", ("analyze_medical_document",)),
+)
+
+
+def _load_tools() -> List[Any]:
+    """Import the tool modules and return the agent's tools in declaration order"""
+    tools = []
+    for module_name, tool_names in _TOOL_SPECS:
+        module = importlib.import_module(module_name, __package__)
+        tools.extend(getattr(module, name) for name in tool_names)
+    return tools
+
+class ChatbotAgent:
+    """LangChain agent implementation for food delivery chatbot"""
+    
+    def __init__(self):
+        """Initialize the chatbot agent with LLM, tools, and memory"""
+        # Share the process-wide LLM, prompt, tools and executor
+        (self.llm, self._system_message, self.prompt, self.tools,
+         self.agent, self.agent_executor) = self._build_agent_components()
+        
+        # Initialize the memory manager (needed for image processing)
+        self.memory_manager = ConversationMemoryManager(window_size=10)
+        
+        # Replays recent text-only search responses for repeated queries
+        self.response_cache = ResponseCache()
+    
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def _build_agent_components(cls) -> Tuple[Any, SystemMessage, ChatPromptTemplate, List[Any], Any, AgentExecutor]:
+        """Build the LLM, prompt, tools and agent executor once per process
+        
+        AgentExecutor keeps no per-call state when memory=None, so a single
+        executor can serve concurrent ainvoke calls from every instance.
+        """
+        # Initialize Bedrock client and LLM; identical agent steps are served from cache
+        llm = BedrockClientSetup.get_llm(cache=LLMCache())
+        
+        # Build the system message once; it's static and reused for every turn
+        system_message = _build_system_message()
+        prompt = cls._get_enhanced_prompt_template(system_message)
+        
+        tools = _load_tools()
+        
+        # Create the tool calling agent (no memory - we use frontend history instead)
+        agent = create_tool_calling_agent(
+            llm=llm,
+            tools=tools,
+            prompt=prompt
+        )
+        
+        # Create a single agent executor (memory-free version)
+        # Tool calls returned together in one LLM step are already awaited
+        # concurrently by AgentExecutor, so independent lookups cost
+        # max(latency) rather than sum(latency) once the model batches them
+        agent_executor = AgentExecutor(
+            agent=agent,
+            tools=tools,
+            verbose=False,  # UI events come from EnhancedStreamingHandler
+            memory=None,  # No memory - history comes from frontend now
+            handle_parsing_errors=True,
+            # The longest flow (refund: workflow, order, criteria, image check,
+            # update, decision, refund) needs ~8 steps; anything past this is a loop
+            max_iterations=10,
+            max_execution_time=120
+        )
+        
+        return llm, system_message, prompt, tools, agent, agent_executor
+    
+    @staticmethod
+    def _get_enhanced_prompt_template(system_message: SystemMessage) -> ChatPromptTemplate:
+        """Create an enhanced prompt template that encourages multi-step reasoning"""
+        prompt = ChatPromptTemplate.from_messages([
+            system_message,
             ("human", "{human_input}"),
+            # Per-turn context messages (e.g. image upload notes)
+            MessagesPlaceholder(variable_name="turn_context", optional=True),
             ("ai", "I'll help you with that. Let me think through this step by step."),
             MessagesPlaceholder(variable_name="agent_scratchpad"),
         ])
@@ -279,181 +569,33 @@ Remember the context of previous messages in the conversation.
     
     def _extract_structured_data(self, output: Any, tool_name: str = None) -> List[Dict[str, Any]]:
         """Extract structured data from tool outputs for rendering in UI"""
-        structured_data = []
-        
         if not isinstance(output, dict):
-            return structured_data
-            
-        print(f"[DEBUG EXTRACT] Extracting structured data from tool output {tool_name}")
+            return []
         
-        # Case 1: Direct structured data
-        if "type" in output and "data" in output:
-            print(f"[DEBUG EXTRACT] Found direct structured data with type: {output['type']}")
-            structured_data.append(output)
-            
-        # Case 2: Restaurant info from get_restaurant_menu
-        elif "restaurant_info" in output:
-            print(f"[DEBUG EXTRACT] Found restaurant_info in tool output")
-            restaurant_card = {
-                "type": "restaurant",
-                "data": output["restaurant_info"]
-            }
-            structured_data.append(restaurant_card)
-            
-            # Also check for any food items
-            if "featured_items" in output and isinstance(output["featured_items"], list):
-                print(f"[DEBUG EXTRACT] Found {len(output['featured_items'])} featured items")
-                for item in output["featured_items"][:5]:  # Limit to 5 items
-                    rest_name = output.get("restaurant_name", "Restaurant")
-                    rest_id = output.get("restaurant_id", "unknown")
-                    
-                    food_card = {
-                        "type": "food_item",
-                        "data": {
-                            **item,
-                            "restaurant_name": rest_name,
-                            "restaurant_id": rest_id,
-                        }
-                    }
-                    structured_data.append(food_card)
-                    
-        # Case 3: Results array with structured data
-        elif "results" in output and isinstance(output["results"], list):
-            print(f"[DEBUG EXTRACT] Found results array with {len(output['results'])} items")
-            for item in output["results"][:10]:  # Limit to 10 items
-                if isinstance(item, dict):
-                    # Already has type/data format
-                    if "type" in item and "data" in item:
-                        structured_data.append(item)
-                        print(f"[DEBUG EXTRACT] Added typed result: {item['type']}")
-                    # Try to infer type from properties
-                    elif "name" in item:
-                        if "price" in item or "description" in item:
-                            food_card = {"type": "food_item", "data": item}
-                            structured_data.append(food_card)
-                            print(f"[DEBUG EXTRACT] Added inferred food item: {item.get('name', 'Unknown')}")
-                        elif "rating" in item or "cuisines" in item:
-                            restaurant_card = {"type": "restaurant", "data": item}
-                            structured_data.append(restaurant_card)
-                            print(f"[DEBUG EXTRACT] Added inferred restaurant: {item.get('name', 'Unknown')}")
-                            
-        # Case 4: Menu array
-        elif "menu" in output and isinstance(output["menu"], list):
-            print(f"[DEBUG EXTRACT] Found menu array with {len(output['menu'])} categories")
-            
-            # First add restaurant info if available
-            rest_name = output.get("restaurant_name", "Restaurant")
-            rest_id = output.get("restaurant_id", "unknown")
-            
-            restaurant_card = {
-                "type": "restaurant",
-                "data": {
-                    "name": rest_name,
-                    "id": rest_id,
-                    "cuisines": output.get("cuisines", []),
-                    "rating": output.get("rating", "N/A")
-                }
-            }
-            structured_data.append(restaurant_card)
-            print(f"[DEBUG EXTRACT] Added basic restaurant card for {rest_name}")
-            
-            # Process a limited number of items from each category
-            item_count = 0
-            for category in output["menu"]:
-                if "items" not in category or not isinstance(category["items"], list):
-                    continue
-                    
-                category_name = category.get("category", "")
-                print(f"[DEBUG EXTRACT] Processing category: {category_name}")
-                
-                # Process up to 3 items per category
-                for idx, item in enumerate(category["items"]):
-                    if idx >= 3:  # Limit items per category
-                        break
-                        
-                    if item_count >= 10:  # Overall limit
-                        break
-                        
-                    food_card = {
-                        "type": "food_item",
-                        "data": {
-                            **item,
-                            "restaurant_name": rest_name,
-                            "restaurant_id": rest_id,
-                            "category": category_name
-                        }
-                    }
-                    structured_data.append(food_card)
-                    item_count += 1
-                    
-                if item_count >= 10:  # Overall limit
-                    break
-                    
-        # Case 5: Special case for order details
-        elif (("order_id" in output and "items" in output) or 
-              ("status" in output and "order_id" in output)):
-            if "type" not in output:
-                # Infer order_details type
-                order_card = {"type": "order_details", "data": output}
-                structured_data.append(order_card)
-                print(f"[DEBUG EXTRACT] Added inferred order details")
-                
-        # Case 6: Check for refund status
-        elif "refund_status" in output or ("refund" in output and "status" in output):
-            if "type" not in output:
-                # Infer refund_status type
-                refund_card = {"type": "refund_status", "data": output}
-                structured_data.append(refund_card)
-                print(f"[DEBUG EXTRACT] Added inferred refund status")
-                
-        # Case 7: Check for image verification result
-        elif "verification_score" in output or "verification_status" in output:
-            print(f"[DEBUG EXTRACT] Found image verification result")
-            image_verification = {
-                "type": "image_verification_result",
-                "data": output
-            }
-            structured_data.append(image_verification)
-            print(f"[DEBUG EXTRACT] Added image verification result")
-            
-        # Case 8: Check for refund workflow state
-        elif ((tool_name == "create_refund_workflow" or 
-               tool_name == "update_refund_workflow" or
-               tool_name == "get_refund_workflow_state") and
-              (("status" in output and "workflow_id" in output) or
-               "current_stage" in output)):
-            print(f"[DEBUG EXTRACT] Found refund workflow state")
-            workflow_state = {
-                "type": "refund_workflow_state",
-                "data": output
-            }
-            structured_data.append(workflow_state)
-            print(f"[DEBUG EXTRACT] Added refund workflow state")
-            
-        # Case 9: Check for document analysis result
-        elif tool_name == "analyze_medical_document" or "document_type" in output or (
-              "type" in output and output["type"] == "document_analysis_result"):
-            print(f"[DEBUG EXTRACT] Found document analysis result")
-            # Ensure we're passing the data in the right format
-            if "type" in output and output["type"] == "document_analysis_result" and "data" in output:
-                document_data = output
-            else:
-                document_data = {
-                    "type": "document_analysis_result",
-                    "data": output
-                }
-            structured_data.append(document_data)
-            print(f"[DEBUG EXTRACT] Added document analysis result")
-                
-        print(f"[DEBUG EXTRACT] Extracted {len(structured_data)} structured data items")
-        return structured_data
+        # Fingerprint the output once, then look up the handlers for that signature
+        signature = output.keys() & _DISCRIMINATOR_KEYS
+        if output.get("type") == "document_analysis_result":
+            signature.add(_SIG_DOCUMENT_RESULT)
+        if tool_name in _WORKFLOW_TOOLS:
+            signature.add(_SIG_WORKFLOW_TOOL)
+        elif tool_name == "analyze_medical_document":
+            signature.add(_SIG_DOCUMENT_TOOL)
+        
+        for handler in _handlers_for(frozenset(signature)):
+            structured_data = handler(output)
+            if structured_data is not None:
+                if __debug__ and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Extracted %d structured data items from %s via %s",
+                                 len(structured_data), tool_name, handler.__name__)
+                return structured_data
+        
+        return []
         
-    def _route_event(self, event: Dict[str, Any], main_queue: asyncio.Queue, 
-                     structured_data_queue: asyncio.Queue) -> None:
-        """Route events to the appropriate queue based on their type"""
+    async def _route_event(self, event: Dict[str, Any], event_queue: asyncio.PriorityQueue,
+                           sequence: Iterator[int]) -> None:
+        """Route events onto the stream queue, ahead of regular events for structured data"""
         try:
-            # Debug event details
-            print(f"[DEBUG CRITICAL] _route_event received event of type: {event.get('type')}")
+            logger.debug("[ROUTE] Received event of type: %s", event.get("type"))
             
             # For tool_end events, check if they have structured data potential
             if event.get("type") == "tool_end" and "output" in event:
@@ -462,212 +604,193 @@ Remember the context of previous messages in the conversation.
                 
                 # Extract any structured data from the tool output
                 structured_items = self._extract_structured_data(output, tool_name)
-                
-                # Emit each structured data item as a separate event
-                for item in structured_items:
-                    structured_event = {
-                        "type": "structured_data",
-                        "data": item
-                    }
-                    print(f"[DEBUG CRITICAL] Emitting structured_data event for {item['type']}")
-                    structured_data_queue.put_nowait(structured_event)
                     
                 # Handle direct type/data format    
                 if isinstance(output, dict) and "type" in output and "data" in output:
-                    print(f"[DEBUG CRITICAL] tool_end event contains direct structured data: {output['type']}")
-                    # Create and emit a structured_data event
-                    structured_event = {
-                        "type": "structured_data",
-                        "data": output
-                    }
-                    print(f"[DEBUG CRITICAL] Creating structured_data event from tool_end: {json.dumps(structured_event)[:150]}")
-                    structured_data_queue.put_nowait(structured_event)
-                    print(f"[DEBUG CRITICAL] Emitted structured_data event to queue")
+                    logger.debug("[ROUTE] tool_end event contains direct structured data: %s", output["type"])
+                    structured_items.append(output)
+                
+                # Queue all of the tool's cards as one entry of ready-made
+                # structured_data events; the consumer just forwards them
+                if structured_items:
+                    logger.debug("[ROUTE] Emitting %d structured_data events", len(structured_items))
+                    await event_queue.put((_PRIORITY_STRUCTURED, next(sequence), {
+                        "type": _STRUCTURED_BATCH,
+                        "data": [{"type": "structured_data", "data": item} for item in structured_items]
+                    }))
             
-            # Special handling for structured_data events - send to dedicated queue
+            # Structured data jumps ahead of regular events in the queue
             if event.get("type") == "structured_data":
-                print(f"[DEBUG CRITICAL] Routing structured_data event to special queue: {json.dumps(event)[:150]}...")
-                print(f"[DEBUG CRITICAL] Before putting in structured_data_queue")
-                structured_data_queue.put_nowait(event)
-                print(f"[DEBUG CRITICAL] After putting in structured_data_queue")
+                logger.debug("[ROUTE] Routing structured_data event with priority")
+                await event_queue.put((_PRIORITY_STRUCTURED, next(sequence), event))
             else:
-                # All other events go to the main queue
-                main_queue.put_nowait(event)
+                await event_queue.put((_PRIORITY_EVENT, next(sequence), event))
                 
         except Exception as e:
-            print(f"[ERROR CRITICAL] Error routing event: {e}")
-            # Print full traceback for debugging
-            import traceback
-            traceback.print_exc()
-            # Try to put it in the main queue as fallback
+            logger.exception("Error routing event: %s", e)
+            # Try to put it in the queue as a regular event as fallback
             try:
-                main_queue.put_nowait(event)
+                await event_queue.put((_PRIORITY_EVENT, next(sequence), event))
             except Exception as inner_e:
-                print(f"[ERROR CRITICAL] Could not route event to any queue: {event.get('type')}, error: {inner_e}")
+                logger.error("Could not route event to any queue: %s, error: %s", event.get("type"), inner_e)
     
     async def _get_streaming_response(
         self, 
         user_input: str,
         conversation_id: str,
         image_data: str = None,
-        latitude: float = 12.9716,
-        longitude: float = 77.5946
+        latitude: float = DEFAULT_LATITUDE,
+        longitude: float = DEFAULT_LONGITUDE,
+        image_note: Optional[str] = None,
+        run_info: Optional[Dict[str, Any]] = None
     ) -> AsyncGenerator[Dict[str, Any], None]:
-        """Process user input and stream response"""
-        # Collect structured data from tool outputs
-        structured_data = []
+        """Process user input and stream response
         
-        # Create queues to handle streaming events
-        event_queue = asyncio.Queue()
-        structured_data_queue = asyncio.Queue()
+        The image note travels as its own per-turn message, separate from the
+        user's own text and after the cached prompt prefix. If a run_info dict
+        is passed, "cacheable" is set in it once the final answer is known,
+        False for fallbacks (loop guard, early stop, errors).
+        """
+        # Single bounded queue of (priority, sequence, event) entries; the sequence
+        # keeps FIFO order within a priority and avoids ever comparing event dicts
+        event_queue = asyncio.PriorityQueue(maxsize=_STREAM_QUEUE_SIZE)
+        sequence = itertools.count()
         
-        # Create streaming callback handler with routing function
+        # Create streaming callback handler that routes straight onto the queue
         streaming_handler = EnhancedStreamingHandler(
-            stream_func=lambda event: self._route_event(event, event_queue, structured_data_queue)
+            stream_func=functools.partial(self._route_event, event_queue=event_queue, sequence=sequence)
         )
         
         # Format chat history for better context awareness
         # If the message is asking about previous conversation, add a note to ensure
         # the model properly checks the chat history
         enhanced_input = user_input
-        memory_related_keywords = [
-            "what did i ask", "previous", "earlier", "first question", 
-            "remember", "summarize", "conversation", "chat history"
-        ]
-        
-        if any(keyword in user_input.lower() for keyword in memory_related_keywords):
+        if _MEMORY_QUERY_RE.search(user_input):
             # This appears to be a message about the conversation history, make sure 
             # we emphasize the chat history for the model
             enhanced_input = f"[CONVERSATION HISTORY QUERY] {user_input}"
         
+        turn_context = [HumanMessage(content=image_note)] if image_note else []
+        
         # Store image data for tools to access, but don't create multimodal message
         # The verify_refund_image tool will use this directly
         if image_data:
-            print(f"[DEBUG IMAGE] Processing image data of length: {len(image_data) if image_data else 0}")
+            logger.debug("[IMAGE] Processing image data of length: %d", len(image_data))
             # Add specific text to help agent recognize image upload
-            if "refund" in enhanced_input.lower():
-                enhanced_input += "\n\nI've uploaded an image to verify my refund request. Please analyze it carefully."
+            if "refund" in user_input.lower():
+                turn_context.append(_IMAGE_REFUND_NOTE)
             else:
-                enhanced_input += "\n\nI've uploaded an image for you to analyze."
+                turn_context.append(_IMAGE_UPLOAD_NOTE)
         
         # Use our agent executor directly (no memory)
         
-        # Global variable to store the current image data for tools to access
-        # This is necessary because we can't directly pass the image in agent_input
-        # without modifying LangChain's AgentExecutor
-        self._current_image_data = image_data if image_data else None
-        self._current_conversation_id = conversation_id
-        
         # Start agent execution in background task
         async def run_agent():
+            # Expose the image and conversation to tools through context variables,
+            # set in this task so concurrent requests don't see each other's
+            CURRENT_IMAGE.set(image_data or None)
+            CURRENT_CONVERSATION_ID.set(conversation_id)
+            
             try:
                 # Always use the agent executor regardless of whether we have an image
                 # The verify_refund_image tool will access the image data when needed
                 
                 # Track if this is an image analysis request in agent input
                 agent_input = {
-                    "human_input": enhanced_input
+                    "human_input": enhanced_input,
+                    "turn_context": turn_context
                 }
                 
                 if image_data:
                     # Add a flag in the input to indicate image presence
                     # This helps the agent know an image was uploaded
                     agent_input["has_image"] = True
-                    print(f"[DEBUG IMAGE] Processing request with image through agent executor")
+                    logger.debug("[IMAGE] Processing request with image through agent executor")
                 
                 # Execute the agent with the prepared input
-                return await self.agent_executor.ainvoke(
+                output = await self.agent_executor.ainvoke(
                     agent_input,
                     config={
-                        "callbacks": [streaming_handler]
+                        "callbacks": [ToolLoopGuardHandler(), streaming_handler]
                     }
                 )
+                cacheable = not str(output.get("output", "")).startswith(_EARLY_STOP_PREFIX)
+            except RepeatedToolCallError as e:
+                # Loop caught before re-running the tool; earlier results were already streamed
+                output = {"output": (
+                    f"I already ran {e.tool} with the same details and it didn't turn up anything new. "
+                    "Could you rephrase your request or add more details?"
+                )}
+                cacheable = False
             except Exception as e:
-                print(f"[ERROR] Agent execution error: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                await event_queue.put({
+                logger.exception("Agent execution error: %s", e)
+                await event_queue.put((_PRIORITY_EVENT, next(sequence), {
                     "type": "error",
                     "data": f"Error processing request: {str(e)}"
-                })
-                return {"output": f"Error: {str(e)}"}
+                }))
+                output = {"output": f"Error: {str(e)}"}
+                cacheable = False
+            
+            # Sentinel queued behind every pending event tells the consumer to stop
+            await event_queue.put((_PRIORITY_DONE, next(sequence), None))
+            return output, cacheable
         
-        # Start the agent in background
+        # Start the agent in background so it keeps producing while we deliver
         agent_task = asyncio.create_task(run_agent())
         
         # Yield initial thinking event
-        yield {"type": "thinking", "data": "Analyzing your request..."}
+        yield _THINKING_EVENT
         
         # Stream events from queue while agent is running
-        structured_data_items = []  # Track items we've already yielded
-        
-        while not agent_task.done() or not event_queue.empty() or not structured_data_queue.empty():
-            try:
-                # First check for any structured data events (prioritize these)
-                try:
-                    structured_event = await asyncio.wait_for(structured_data_queue.get(), timeout=0.01)
-                    
-                    # Add to tracking list to avoid duplicates
-                    event_id = hash(json.dumps(structured_event, default=str))
-                    structured_data_items.append(event_id)
-                    
-                    yield structured_event
-                    continue  # Continue to the next iteration to check for more structured data
-                except asyncio.TimeoutError:
-                    # No structured data available, try regular events
-                    pass
+        try:
+            while True:
+                priority, _, event = await event_queue.get()
+                if priority == _PRIORITY_DONE:
+                    break
                 
-                # Get next regular event with timeout
-                try:
-                    event = await asyncio.wait_for(event_queue.get(), timeout=0.1)
-                    
-                    # Yield the event to the client
-                    yield event
-                    
-                    # Process structured data from tool outputs for backward compatibility
-                    if event.get("type") == "tool_end" and "output" in event:
-                        output = event.get("output")
-                        if isinstance(output, dict):
-                            # Extract structured data from the output
-                            extracted_data = self._extract_structured_data(output)
-                            if extracted_data:
-                                structured_data.extend(extracted_data)
-                except asyncio.TimeoutError:
-                    # No event available yet, continue the loop
-                    pass
+                # Forward the cards extracted from a tool's output
+                if event["type"] == _STRUCTURED_BATCH:
+                    for structured_event in event["data"]:
+                        yield structured_event
+                    continue
                 
-            except Exception as e:
-                # Other errors
-                print(f"[ERROR] Error processing events: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                yield {"type": "error", "data": f"Streaming error: {str(e)}"}
-                break
+                # Yield the event to the client
+                yield event
+                
+        except (GeneratorExit, asyncio.CancelledError):
+            # The client went away mid-stream; don't leave the agent blocked on a full queue
+            agent_task.cancel()
+            raise
+        except Exception as e:
+            # Other errors; nothing drains the queue any more, so stop the agent
+            # rather than awaiting a task that may be blocked on a full queue
+            logger.exception("Error processing events: %s", e)
+            agent_task.cancel()
+            yield {"type": "error", "data": f"Streaming error: {str(e)}"}
+            yield {"type": "done", "conversation_id": conversation_id}
+            return
         
         # Get the agent's final output
         try:
-            output = await agent_task
+            output, cacheable = await agent_task
             
             # Extract the final response
             final_message = output.get("output", "I'm not sure how to respond to that.")
             
-            # For image processing, store response in memory manager
+            # For image processing, store the whole turn in memory manager
             if image_data:
-                self.memory_manager.add_ai_message(conversation_id, final_message)
+                self.memory_manager.add_turn(conversation_id, user_input, final_message)
+            
+            # Report whether the answer can be reused, off the client-facing stream
+            if run_info is not None:
+                run_info["cacheable"] = cacheable
             
             # Return the final message
             yield {"type": "message", "data": final_message}
-            
-            # Send structured data events
-            for data_item in structured_data:
-                if isinstance(data_item, dict) and "type" in data_item and "data" in data_item:
-                    yield {"type": "structured_data", "data": data_item}
                 
         except Exception as e:
             # Handle errors from awaiting the task
-            print(f"[ERROR] Agent execution error: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Agent execution error: %s", e)
             yield {"type": "error", "data": f"Error in agent execution: {str(e)}"}
         
         # Signal completion with conversation ID to ensure client receives it
@@ -681,39 +804,122 @@ Remember the context of previous messages in the conversation.
         location: Optional[Dict[str, float]] = None,
         media: Optional[Dict[str, Any]] = None
     ) -> AsyncGenerator[Dict[str, Any], None]:
-        """Process a message and return a streaming response"""
+        """Process a message and return a streaming response
+        
+        The stream always ends with exactly one "done" event carrying the
+        conversation ID, even if processing fails part way through.
+        """
         # Generate a conversation ID if not provided
         if not conversation_id:
             conversation_id = "default"
             
-        print(f"[DEBUG MEMORY] Processing message for conversation: {conversation_id}")
-        
-        # Extract location if provided
-        latitude = location.get("latitude", 12.9716) if location else 12.9716
-        longitude = location.get("longitude", 77.5946) if location else 77.5946
-        
-        # Process image data if present
-        image_data = None
-        if media and media.get("type") == "image" and media.get("data"):
-            # Extract the image data
-            image_data = media.get("data")
-            print(f"[DEBUG IMAGE] Received image with metadata: {media.get('metadata', {})}")
+        logger.debug("[MEMORY] Processing message for conversation: %s", conversation_id)
+        
+        done_sent = False
+        try:
+            # Parse location and media in one pass, then take the specialized path
+            ctx = _parse_request(location, media)
+            if ctx.image_data:
+                stream = self._process_multimodal(message, conversation_id, ctx)
+            else:
+                stream = self._process_text(message, conversation_id, user_id, ctx.latitude, ctx.longitude)
             
-            # Add context to the message for better image understanding
-            image_metadata = media.get("metadata", {})
-            filename = image_metadata.get("name", "uploaded image")
-            message = f"{message}\n\n[Note: I've attached an image of {filename} for you to analyze]"
+            async for response_chunk in stream:
+                if response_chunk.get("type") == "done":
+                    done_sent = True
+                yield response_chunk
+        except Exception as e:
+            logger.exception("Error processing message: %s", e)
+            yield {"type": "error", "data": f"Error processing message: {str(e)}"}
         
-        # Store message in memory for image processing path only
-        # The regular text path uses history from frontend
-        self.memory_manager.add_user_message(conversation_id, message)
+        # Not in a finally: yielding while the client is closing the stream would fail
+        if not done_sent:
+            yield {"type": "done", "conversation_id": conversation_id}
+    
+    async def _process_multimodal(
+        self,
+        message: str,
+        conversation_id: str,
+        ctx: RequestContext
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Stream the response to a message with an attached image"""
+        logger.debug("[IMAGE] Received image: %s", ctx.image_name)
         
-        # Process the message with conversation-specific memory
+        # Add context for better image understanding, leaving the user's text untouched
+        image_note = f"[Note: I've attached an image of {ctx.image_name} for you to analyze]"
+        
+        # The turn is stored in memory once the response is final (image path
+        # only; the regular text path uses history from frontend)
         async for response_chunk in self._get_streaming_response(
             message,
             conversation_id,
-            image_data,
-            latitude,
-            longitude
+            ctx.image_data,
+            ctx.latitude,
+            ctx.longitude,
+            image_note
         ):
             yield response_chunk
+    
+    async def _process_text(
+        self,
+        message: str,
+        conversation_id: str,
+        user_id: Optional[str],
+        latitude: float,
+        longitude: float
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Stream the response to a text-only message, serving it from the response cache when possible"""
+        cache_key = ResponseCache.make_key(message, latitude, longitude, user_id)
+        cached_chunks = self.response_cache.get(cache_key)
+        owns_pending = False
+        if cached_chunks is None:
+            # Identical queries arriving together share a single agent run
+            pending = self.response_cache.join(cache_key)
+            if pending is None:
+                owns_pending = True
+            else:
+                logger.debug("[CACHE] Waiting on identical in-flight query for conversation: %s", conversation_id)
+                cached_chunks = await asyncio.shield(pending)
+        if cached_chunks is not None:
+            logger.debug("[CACHE] Replaying cached response for conversation: %s", conversation_id)
+            for response_chunk in cached_chunks:
+                yield response_chunk
+            yield {"type": "done", "conversation_id": conversation_id}
+            return
+        
+        # Record the response while streaming it, unless it can't be reused
+        recorded_chunks = []
+        run_info = {}
+        
+        try:
+            async for response_chunk in self._get_streaming_response(
+                message,
+                conversation_id,
+                latitude=latitude,
+                longitude=longitude,
+                run_info=run_info
+            ):
+                if recorded_chunks is not None:
+                    chunk_type = response_chunk.get("type")
+                    if chunk_type == "error" or (
+                        chunk_type == "agent_action"
+                        and response_chunk.get("tool_name") not in ResponseCache.CACHEABLE_TOOLS
+                    ):
+                        recorded_chunks = None
+                    elif chunk_type != "done":
+                        recorded_chunks.append(response_chunk)
+                yield response_chunk
+            
+            # Fallback answers (loop guard, early stop, errors) are never cached
+            if recorded_chunks and run_info.get("cacheable"):
+                self.response_cache.set(cache_key, recorded_chunks)
+        finally:
+            # Waiting duplicates run the agent themselves if nothing was cached
+            if owns_pending:
+                self.response_cache.release(cache_key)
+
+
+@functools.lru_cache(maxsize=1)
+def get_agent() -> ChatbotAgent:
+    """Get the process-wide ChatbotAgent, creating it on first use"""
+    return ChatbotAgent()
@@ -0,0 +1,220 @@
+"""
+In-process caches used by the chatbot agent to skip repeated work across requests.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from langchain_core.caches import BaseCache
+from langchain_core.outputs import Generation
+
+
+class TTLCache:
+    """
+    Bounded mapping whose entries expire after a fixed time.
+
+    Least recently used entries are evicted once max_entries is reached.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        """
+        Initialize the cache
+
+        Args:
+            max_entries: Maximum number of entries (least recently used are evicted)
+            ttl_seconds: How long an entry stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get the value for a key
+
+        Args:
+            key: Cache key
+
+        Returns:
+            Cached value, or None on a miss or expired entry
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Store a value
+
+        Args:
+            key: Cache key
+            value: Value to cache
+        """
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all entries"""
+        self._entries.clear()
+
+
+class ResponseCache(TTLCache):
+    """
+    TTL + LRU cache of streamed agent responses.
+
+    Responses are keyed on the normalized user message, a ~1km location bucket and
+    the user ID, so a repeated query from the same place replays the recorded
+    chunk sequence instead of invoking the LLM and tools again.
+    """
+
+    # Tools whose results depend only on their arguments and the location; any
+    # other tool (orders, refunds, images) makes a response uncacheable
+    CACHEABLE_TOOLS = frozenset({
+        "search_restaurants",
+        "search_restaurants_direct",
+        "search_food_items_enhanced",
+        "get_restaurant_menu",
+        "get_restaurant_menus_bulk",
+    })
+
+    def __init__(self, max_entries=256, ttl_seconds=300):
+        """
+        Initialize the response cache
+
+        Args:
+            max_entries: Maximum number of cached responses (least recently used are evicted)
+            ttl_seconds: How long a cached response stays valid
+        """
+        super().__init__(max_entries, ttl_seconds)
+        # Responses currently being produced, so identical concurrent queries
+        # wait for one agent run instead of starting their own
+        self._pending: Dict[Hashable, "asyncio.Future"] = {}
+
+    @staticmethod
+    def make_key(message: str, latitude: float, longitude: float, user_id: Optional[str] = None) -> Hashable:
+        """
+        Build the cache key for a message
+
+        Args:
+            message: User message text
+            latitude: User latitude
+            longitude: User longitude
+            user_id: Optional user identifier
+
+        Returns:
+            Hashable cache key
+        """
+        normalized = " ".join(message.lower().split())
+        # Two decimal places is roughly a 1km grid
+        return (normalized, round(latitude, 2), round(longitude, 2), user_id)
+
+    def set(self, key: Hashable, chunks: List[Dict[str, Any]]) -> None:
+        """
+        Record the chunks of a completed response
+
+        Args:
+            key: Cache key from make_key
+            chunks: Response chunks, excluding the final "done" event
+        """
+        super().set(key, chunks)
+        self.release(key, chunks)
+
+    def join(self, key: Hashable) -> Optional["asyncio.Future"]:
+        """
+        Join an identical response that is already being produced
+
+        If none is in flight, the caller is registered as its producer and must
+        call set() or release() for the key once done.
+
+        Args:
+            key: Cache key from make_key
+
+        Returns:
+            Future resolving to the producer's chunks (None if it could not be
+            cached), or None if the caller is the producer
+        """
+        future = self._pending.get(key)
+        if future is not None:
+            return future
+
+        self._pending[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def release(self, key: Hashable, chunks: Optional[List[Dict[str, Any]]] = None) -> None:
+        """
+        Hand a produced response to the requests waiting on it
+
+        Args:
+            key: Cache key from make_key
+            chunks: Response chunks, or None if the response can't be shared
+        """
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(chunks)
+
+
+class LLMCache(BaseCache):
+    """
+    TTL + LRU cache of LLM generations for LangChain models.
+
+    Keyed on the exact rendered prompt (system prompt, user message and the
+    agent's scratchpad so far) and the model settings. At temperature 0 an
+    identical prompt yields the same step, so repeated agent steps, typically
+    the first planning call for a common query, skip the Bedrock round trip.
+    """
+
+    # Steps that call these tools act on a user's order or refund and are
+    # never replayed from cache
+    UNCACHEABLE_TOOLS = frozenset({
+        "initiate_refund",
+        "create_refund_workflow",
+        "update_refund_workflow",
+        "process_refund_decision",
+    })
+
+    def __init__(self, max_entries=512, ttl_seconds=600):
+        """
+        Initialize the LLM cache
+
+        Args:
+            max_entries: Maximum number of cached generations (least recently used are evicted)
+            ttl_seconds: How long a cached generation stays valid
+        """
+        self._entries = TTLCache(max_entries, ttl_seconds)
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        """Look up cached generations for a prompt and model configuration"""
+        return self._entries.get((prompt, llm_string))
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        """Cache generations unless they call a tool that changes an order or refund"""
+        for generation in return_val:
+            tool_calls = getattr(getattr(generation, "message", None), "tool_calls", None) or ()
+            if any(call["name"] in self.UNCACHEABLE_TOOLS for call in tool_calls):
+                return
+        self._entries.set((prompt, llm_string), return_val)
+
+    def clear(self, **kwargs: Any) -> None:
+        """Drop all cached generations"""
+        self._entries.clear()
+
+    # In-memory operations are cheap; skip BaseCache's default thread-pool hop
+    async def alookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        return self.lookup(prompt, llm_string)
+
+    async def aupdate(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        self.update(prompt, llm_string, return_val)
+
+    async def aclear(self, **kwargs: Any) -> None:
+        self.clear()
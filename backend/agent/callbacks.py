@@ -1,29 +1,289 @@
 """
 Custom callback handlers for LangChain agents
 """
-from typing import Dict, Any, List, Optional, AsyncGenerator, Callable, Union
-import json
-from datetime import datetime
+from typing import Dict, Any, Awaitable, Iterator, List, Optional, AsyncGenerator, Callable, Tuple, Union
+import inspect
+import logging
+import re
+import time
+from asyncio import iscoroutine
+from collections import deque
+from itertools import islice
+
+import orjson
 
 from langchain_core.callbacks.base import AsyncCallbackHandler
 from langchain_core.messages import BaseMessage
 
+from .cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+# Reasoning steps a handler keeps for later retrieval; older steps are dropped
+MAX_REASONING_STEPS = 64
+
+# Tool-use phrasing rewritten to "Using", and the phrases that open the actual
+# reasoning in a verbose LLM thought
+_USING_RE = re.compile(r"I(?:'ll| need to| will) use")
+_THINKING_MARKER_RE = re.compile(r"I'll|I will|I need to|I should|I'm going to|Let me")
+
+# Tools whose untyped results are restaurants / food items
+_RESTAURANT_TOOLS = frozenset({"search_restaurants", "search_restaurants_direct"})
+_FOOD_TOOLS = frozenset({"search_food_items", "get_restaurant_menu"})
+
+# Keys that, next to a "name", mark untyped data as a restaurant / food item
+_RESTAURANT_KEYS = frozenset({"rating", "cuisine"})
+_FOOD_KEYS = frozenset({"price", "description", "cost"})
+
+# What an entry of a tool's "results" array turned out to be
+_RESULT_UNKNOWN, _RESULT_RESTAURANT, _RESULT_FOOD = range(3)
+
+
+def _to_json(obj: Any) -> str:
+    """Serialize an object to JSON for log output, stringifying anything orjson can't encode"""
+    return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _parse_json_text(value: Any) -> Any:
+    """
+    Parse a string holding a JSON object or array, returning anything else unchanged
+    
+    Only strings that open and close like JSON are parsed, so plain text never
+    pays for a failed parse.
+    """
+    if isinstance(value, str) and len(value) > 1 and value[0] in "{[" and value[-1] in "}]":
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            pass
+    return value
+
+
+def _is_new_card(seen_cards: set, card: Dict[str, Any]) -> bool:
+    """
+    Record a structured data card, returning False if an identical one was already sent
+    
+    Cards are identified by type, ID (or name) and restaurant, so the same dish
+    from two restaurants is still shown twice. Cards without an ID or name are
+    never treated as duplicates.
+    """
+    data = card.get("data")
+    if not isinstance(data, dict):
+        return True
+    
+    identity = data.get("id") or data.get("name")
+    if identity is None:
+        return True
+    
+    key = (card.get("type"), str(identity), str(data.get("restaurant_id")))
+    if key in seen_cards:
+        return False
+    seen_cards.add(key)
+    return True
+
+
+async def _discard_event(event_data: Dict[str, Any]) -> None:
+    """Stream function for handlers created without one"""
+
+
+def _as_async_emitter(stream_func: Callable[[Dict[str, Any]], Any]) -> Callable[[Dict[str, Any]], Awaitable[None]]:
+    """
+    Adapt a stream function to a coroutine function, deciding once how to call it
+    
+    Args:
+        stream_func: Sync or async function that will be called with events to stream
+        
+    Returns:
+        stream_func itself if it's a coroutine function, a no-op if there is no
+        stream_func, else an async wrapper
+    """
+    if stream_func is None:
+        logger.warning("stream_func is None, events from this handler will not be streamed")
+        return _discard_event
+    
+    if inspect.iscoroutinefunction(stream_func):
+        return stream_func
+    
+    async def emit(event_data: Dict[str, Any]) -> None:
+        result = stream_func(event_data)
+        # A plain function may still hand back an awaitable (e.g. a lambda around a coroutine)
+        if iscoroutine(result) or hasattr(type(result), '__await__'):
+            await result
+    
+    return emit
+
+
+def _menu_food_cards(output: Dict[str, Any], max_categories: Optional[int] = None,
+                     default_category: str = "") -> Iterator[Dict[str, Any]]:
+    """
+    Build food item cards from a get_restaurant_menu style output
+    
+    Takes the first 3 items of each menu category, tagged with the restaurant
+    and category they belong to.
+    
+    Args:
+        output: Tool output with a "menu" list of categories
+        max_categories: Only look at this many categories (all if None)
+        default_category: Category name for categories without one
+    """
+    rest_name = output.get("restaurant_name", "Restaurant")
+    rest_id = output.get("restaurant_id", "unknown")
+    
+    for category in islice(output["menu"], max_categories):
+        items = category.get("items")
+        if not isinstance(items, list):
+            continue
+        
+        category_name = category.get("category", default_category)
+        for item in islice(items, 3):  # Limit items to avoid overwhelming the UI
+            item_data = item.copy()
+            item_data["restaurant_name"] = rest_name
+            item_data["restaurant_id"] = rest_id
+            item_data["category"] = category_name
+            yield {"type": "food_item", "data": item_data}
+
+
+def _classify_result(result: Any, is_restaurant_search: bool,
+                     is_food_search: bool) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """
+    Classify one entry of a tool's "results" array as a restaurant or food item
+    
+    Args:
+        result: Entry of the results array
+        is_restaurant_search: Whether the tool returns restaurants
+        is_food_search: Whether the tool returns food items
+        
+    Returns:
+        (_RESULT_RESTAURANT, _RESULT_FOOD or _RESULT_UNKNOWN, card or None)
+    """
+    if not isinstance(result, dict):
+        return _RESULT_UNKNOWN, None
+    
+    # Already properly formatted with type/data
+    result_type = result.get("type")
+    if result_type and result.get("data"):
+        if result_type == "restaurant":
+            return _RESULT_RESTAURANT, result
+        if result_type == "food_item":
+            return _RESULT_FOOD, result
+        return _RESULT_UNKNOWN, None
+    
+    # Nested data structure, or else direct data (flat structure)
+    item_data = result.get("data")
+    if not isinstance(item_data, dict):
+        item_data = result
+    
+    keys = item_data.keys()
+    if is_restaurant_search or ("name" in keys and not keys.isdisjoint(_RESTAURANT_KEYS)):
+        return _RESULT_RESTAURANT, {"type": "restaurant", "data": item_data}
+    if is_food_search or ("name" in keys and not keys.isdisjoint(_FOOD_KEYS)):
+        return _RESULT_FOOD, {"type": "food_item", "data": item_data}
+    return _RESULT_UNKNOWN, None
+
+
+def _iter_cards(parsed_output: Dict[str, Any], is_restaurant_search: bool,
+                is_food_search: bool) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the restaurant and food item cards found in a tool's output, in order
+    
+    Args:
+        parsed_output: Tool output
+        is_restaurant_search: Whether the tool returns restaurants
+        is_food_search: Whether the tool returns food items
+    """
+    # Case 1: Results array with type awareness
+    results = parsed_output.get("results")
+    if isinstance(results, list):
+        logger.debug("Processing %d results from tool output", len(results))
+        for result in results:
+            result_kind, card = _classify_result(result, is_restaurant_search, is_food_search)
+            # Only cards with something to show
+            if result_kind != _RESULT_UNKNOWN and card.get("data"):
+                yield card
+    
+    # Case 2: Menu structure from get_restaurant_menu tool
+    elif isinstance(parsed_output.get("menu"), list):
+        menu = parsed_output["menu"]
+        restaurant_name = parsed_output.get("restaurant_name", "Restaurant")
+        restaurant_id = parsed_output.get("restaurant_id", "unknown")
+        restaurant_info = parsed_output.get("restaurant_info")
+        featured_items = parsed_output.get("featured_items")
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Found menu array with %d categories", len(menu))
+            logger.debug("Full parsed_output keys: %s", list(parsed_output))
+            
+            # Check for the presence of results
+            if "results" in parsed_output:
+                logger.debug("Found 'results' field with %d items", len(parsed_output['results']))
+            else:
+                logger.debug("No 'results' field found in get_restaurant_menu output")
+                
+            # Log the first few menu items
+            if menu:
+                first_category = menu[0]
+                logger.debug("First menu category: %s", first_category.get('category', 'Unknown'))
+                if "items" in first_category and len(first_category["items"]) > 0:
+                    logger.debug("Sample item: %.150s...", _to_json(first_category['items'][0]))
+        
+        # Restaurant info first, or some basic restaurant info if it's missing
+        if restaurant_info:
+            yield {"type": "restaurant", "data": restaurant_info}
+        else:
+            logger.debug("Created basic restaurant card: %s", restaurant_name)
+            yield {
+                "type": "restaurant",
+                "data": {
+                    "name": restaurant_name,
+                    "id": restaurant_id,
+                    "cuisine": ["Fast Food", "Burgers"],
+                    "menu_available": True
+                }
+            }
+        
+        # Featured/popular items
+        if featured_items and isinstance(featured_items, list):
+            logger.debug("Processing %d featured items", len(featured_items))
+            for item in featured_items:
+                item_data = item.copy()
+                item_data["restaurant_name"] = restaurant_name
+                item_data["restaurant_id"] = restaurant_id
+                item_data["featured"] = True
+                yield {"type": "food_item", "data": item_data}
+        
+        # Always process menu categories regardless of tool type
+        yield from _menu_food_cards(parsed_output, default_category="Menu Items")
+    
+    # Case 3: Direct object is a restaurant
+    elif "name" in parsed_output and not _RESTAURANT_KEYS.isdisjoint(parsed_output):
+        logger.debug("Found direct restaurant data")
+        yield {"type": "restaurant", "data": parsed_output}
+    
+    # Case 4: Direct object is a food item
+    elif "name" in parsed_output and not _FOOD_KEYS.isdisjoint(parsed_output):
+        logger.debug("Found direct food item data")
+        yield {"type": "food_item", "data": parsed_output}
+
 
 class EnhancedStreamingHandler(AsyncCallbackHandler):
     """Enhanced streaming handler that shows step-by-step reasoning"""
     
-    def __init__(self, stream_func: Callable[[Dict[str, Any]], None] = None):
+    def __init__(self, stream_func: Callable[[Dict[str, Any]], None] = None,
+                 max_reasoning_steps: int = MAX_REASONING_STEPS):
         """
         Initialize with a streaming function to send events
         
         Args:
             stream_func: Function that will be called with events to stream
+            max_reasoning_steps: Number of most recent reasoning steps to keep
         """
         super().__init__()
         self.stream_func = stream_func
+        self._emit = _as_async_emitter(stream_func)
+        # Cards already streamed through this handler (one handler per request)
+        self._seen_cards = set()
         self.step_count = 0
-        self.current_step = ""
-        self.reasoning_steps = []  # Track reasoning steps
+        self.reasoning_steps = deque(maxlen=max_reasoning_steps)  # Track recent reasoning steps
     
     async def _safe_stream(self, event_data: Dict[str, Any]) -> None:
         """Safely call stream_func with proper error handling
@@ -31,13 +291,8 @@ class EnhancedStreamingHandler(AsyncCallbackHandler):
         Args:
             event_data: The event data to stream
         """
-        if self.stream_func is None:
-            print(f"Warning: stream_func is None, cannot stream event: {event_data.get('type', 'unknown')}")
-            return
-        
-        # DEBUG: Print event data
         event_type = event_data.get("type", "unknown")
-        print(f"[DEBUG CRITICAL] _safe_stream handling event of type: {event_type}")
+        logger.debug("_safe_stream handling event of type: %s", event_type)
         
         # Special handling for tool_end events to extract structured data
         if event_type == "tool_end" and "output" in event_data:
@@ -46,63 +301,45 @@ class EnhancedStreamingHandler(AsyncCallbackHandler):
             if isinstance(output, dict):
                 # Case 1: Direct extraction - restaurant info in get_restaurant_menu response
                 if "restaurant_info" in output or "menu" in output:
-                    print(f"[DEBUG CRITICAL] Found restaurant/menu data in tool_end")
+                    logger.debug("Found restaurant/menu data in tool_end")
                     
                     # Make sure we extract structured data from this output
                     # This code path may be reached separately from the _extract_structured_data in agent.py
                     if "restaurant_info" in output:
-                        # Create restaurant card
-                        restaurant_event = {
-                            "type": "structured_data",
-                            "data": {"type": "restaurant", "data": output["restaurant_info"]}
-                        }
-                        
-                        # Create separate streaming event
-                        try:
-                            print(f"[DEBUG CRITICAL] Directly emitting restaurant structured data")
-                            await self._safe_stream_direct(restaurant_event)
-                        except Exception as e:
-                            print(f"[ERROR CRITICAL] Error emitting restaurant structured data: {e}")
+                        # Create restaurant card, unless this run already sent it
+                        restaurant_card = {"type": "restaurant", "data": output["restaurant_info"]}
+                        if _is_new_card(self._seen_cards, restaurant_card):
+                            restaurant_event = {
+                                "type": "structured_data",
+                                "data": restaurant_card
+                            }
+                            
+                            # Create separate streaming event
+                            try:
+                                logger.debug("Directly emitting restaurant structured data")
+                                await self._safe_stream_direct(restaurant_event)
+                            except Exception as e:
+                                logger.error("Error emitting restaurant structured data: %s", e)
                             
                     # Process menu items
                     if "menu" in output and isinstance(output["menu"], list):
-                        rest_name = output.get("restaurant_name", "Restaurant")
-                        rest_id = output.get("restaurant_id", "unknown")
-                        
-                        for category in output["menu"][:2]:  # Limit categories
-                            if "items" not in category:
+                        for food_card in _menu_food_cards(output, max_categories=2):
+                            if not _is_new_card(self._seen_cards, food_card):
                                 continue
-                                
-                            for item in category.get("items", [])[:3]:  # Limit items
-                                # Create food item card
-                                food_event = {
-                                    "type": "structured_data",
-                                    "data": {
-                                        "type": "food_item",
-                                        "data": {
-                                            **item,
-                                            "restaurant_name": rest_name,
-                                            "restaurant_id": rest_id,
-                                            "category": category.get("category", "")
-                                        }
-                                    }
-                                }
-                                
-                                # Create separate streaming event
-                                try:
-                                    print(f"[DEBUG CRITICAL] Directly emitting food item structured data")
-                                    await self._safe_stream_direct(food_event)
-                                except Exception as e:
-                                    print(f"[ERROR CRITICAL] Error emitting food item structured data: {e}")
+                            food_event = {"type": "structured_data", "data": food_card}
+                            
+                            # Create separate streaming event
+                            try:
+                                logger.debug("Directly emitting food item structured data")
+                                await self._safe_stream_direct(food_event)
+                            except Exception as e:
+                                logger.error("Error emitting food item structured data: %s", e)
             
         # Normal event streaming
         try:
-            # Call the function but ensure we properly await it if it's a coroutine
-            result = self.stream_func(event_data)
-            if hasattr(result, '__await__'):  # Check if it's awaitable
-                await result
+            await self._emit(event_data)
         except Exception as e:
-            print(f"Error in EnhancedStreamingHandler._safe_stream: {repr(e)}")
+            logger.error("Error in EnhancedStreamingHandler._safe_stream: %r", e)
             # Don't re-raise, we want to continue execution
     
     async def _safe_stream_direct(self, event_data: Dict[str, Any]) -> None:
@@ -110,16 +347,11 @@ class EnhancedStreamingHandler(AsyncCallbackHandler):
         
         This is used for structured data that needs special handling
         """
-        if self.stream_func is None:
-            return
-            
         try:
             # Call the stream function directly
-            result = self.stream_func(event_data)
-            if hasattr(result, '__await__'):  # Check if it's awaitable
-                await result
+            await self._emit(event_data)
         except Exception as e:
-            print(f"[ERROR CRITICAL] Error in direct stream: {repr(e)}")
+            logger.error("Error in direct stream: %r", e)
     
     async def on_agent_action(self, action, **kwargs: Any) -> None:
         """Run on agent action with step counter"""
@@ -137,22 +369,12 @@ class EnhancedStreamingHandler(AsyncCallbackHandler):
         formatted_thought = thought
         if formatted_thought and isinstance(formatted_thought, str):
             # Clean up common patterns in LLM reasoning
-            formatted_thought = formatted_thought.replace(
-                "I'll use", "Using"
-            ).replace(
-                "I need to use", "Using"
-            ).replace(
-                "I will use", "Using"
-            )
+            formatted_thought = _USING_RE.sub("Using", formatted_thought)
             
             # Try to extract the actual reasoning from LLM verbosity
-            thinking_markers = ["I'll", "I will", "I need to", "I should", "I'm going to", "Let me"]
-            for marker in thinking_markers:
-                if marker in formatted_thought:
-                    parts = formatted_thought.split(marker, 1)
-                    if len(parts) > 1:
-                        formatted_thought = f"{marker}{parts[1]}"
-                        break
+            marker = _THINKING_MARKER_RE.search(formatted_thought)
+            if marker:
+                formatted_thought = formatted_thought[marker.start():]
 
         # Store this reasoning step for later retrieval
         self.reasoning_steps.append({
@@ -167,7 +389,7 @@ class EnhancedStreamingHandler(AsyncCallbackHandler):
                 "data": {
                     "step": self.step_count,
                     "thought": formatted_thought,
-                    "timestamp": datetime.now().isoformat()  # Add timestamp to ensure uniqueness
+                    "timestamp": time.time_ns() // 1_000_000  # Epoch millis, to ensure uniqueness
                 }
             })
         
@@ -197,17 +419,22 @@ class EnhancedStreamingHandler(AsyncCallbackHandler):
 class StreamingToolsCallbackHandler(AsyncCallbackHandler):
     """Callback handler that streams agent's thinking process and tool usage"""
     
-    def __init__(self, stream_func: Callable[[Dict[str, Any]], None] = None):
+    def __init__(self, stream_func: Callable[[Dict[str, Any]], None] = None,
+                 max_reasoning_steps: int = MAX_REASONING_STEPS):
         """
         Initialize with a streaming function to send events
         
         Args:
             stream_func: Function that will be called with events to stream
+            max_reasoning_steps: Number of most recent reasoning steps to keep
         """
         super().__init__()
         self.stream_func = stream_func
+        self._emit = _as_async_emitter(stream_func)
+        # Cards already streamed through this handler (one handler per request)
+        self._seen_cards = set()
         self.step_count = 0
-        self.reasoning_steps = []
+        self.reasoning_steps = deque(maxlen=max_reasoning_steps)
         
     async def _safe_stream(self, event_data: Dict[str, Any]) -> None:
         """Safely call stream_func with proper error handling
@@ -215,17 +442,10 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
         Args:
             event_data: The event data to stream
         """
-        if self.stream_func is None:
-            print(f"Warning: stream_func is None, cannot stream event: {event_data.get('type', 'unknown')}")
-            return
-            
         try:
-            # Call the function but ensure we properly await it if it's a coroutine
-            result = self.stream_func(event_data)
-            if hasattr(result, '__await__'):  # Check if it's awaitable
-                await result
+            await self._emit(event_data)
         except Exception as e:
-            print(f"Error in StreamingToolsCallbackHandler._safe_stream: {repr(e)}")
+            logger.error("Error in StreamingToolsCallbackHandler._safe_stream: %r", e)
             # Don't re-raise, we want to continue execution
     
     async def on_llm_start(
@@ -290,7 +510,7 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
                 "data": {
                     "step": self.step_count,
                     "thought": text.strip(),
-                    "timestamp": datetime.now().isoformat(),
+                    "timestamp": time.time_ns() // 1_000_000,
                     "is_thinking": True
                 }
             })
@@ -316,9 +536,10 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
         self.step_count += 1
         
         # More robust tool name extraction with better logging
-        # Inspect the full serialized object to find the name
-        print(f"Tool start serialized: {json.dumps(serialized)}")
-        print(f"Tool start kwargs: {json.dumps(kwargs, default=str)}")
+        # Inspect the full serialized object to find the name (serialized only when debug logging is on)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Tool start serialized: %s", _to_json(serialized))
+            logger.debug("Tool start kwargs: %s", _to_json(kwargs))
         
         # Extract tool name from multiple possible sources
         # Changed: prioritize serialized['name'] over kwargs['name'] since it's more reliable at start time
@@ -328,48 +549,33 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
         if serialized and isinstance(serialized, dict):
             if "name" in serialized:
                 tool_name = serialized["name"]
-                print(f"Found tool name in serialized['name']: {tool_name}")
+                logger.debug("Found tool name in serialized['name']: %s", tool_name)
             elif "metadata" in serialized and "name" in serialized["metadata"]:
                 tool_name = serialized["metadata"]["name"]
-                print(f"Found tool name in serialized metadata: {tool_name}")
+                logger.debug("Found tool name in serialized metadata: %s", tool_name)
             elif "tool" in serialized:
                 if isinstance(serialized["tool"], dict) and "name" in serialized["tool"]:
                     tool_name = serialized["tool"]["name"]
-                    print(f"Found tool name in serialized['tool'] dict: {tool_name}")
+                    logger.debug("Found tool name in serialized['tool'] dict: %s", tool_name)
                 elif isinstance(serialized["tool"], str):
                     tool_name = serialized["tool"]
-                    print(f"Found tool name in serialized['tool'] string: {tool_name}")
+                    logger.debug("Found tool name in serialized['tool'] string: %s", tool_name)
         
         # Fall back to kwargs only if serialized didn't have it
         if tool_name is None and "name" in kwargs and kwargs["name"]:
             tool_name = kwargs["name"]
-            print(f"Found tool name in kwargs: {tool_name}")
+            logger.debug("Found tool name in kwargs: %s", tool_name)
             
-        # Store the input parameters to provide more descriptive messages for the frontend
-        tool_input = None
-        try:
-            if isinstance(input_str, str) and (input_str.startswith('{') or input_str.startswith('[')):
-                tool_input = json.loads(input_str)
-            else:
-                tool_input = input_str
-        except:
-            tool_input = input_str
-        
         # If still None, use the class name or default
         if tool_name is None:
             tool_name = (serialized.get("class", "")).split(".")[-1] or "unknown_tool"
-            print(f"Using fallback tool name: {tool_name}")
+            logger.debug("Using fallback tool name: %s", tool_name)
         
-        print(f"Extracted tool name: {tool_name}")
+        logger.debug("Extracted tool name: %s", tool_name)
         
-        # Try to safely parse input as JSON if it's a string representation of JSON
-        try:
-            if isinstance(input_str, str) and (input_str.startswith('{') or input_str.startswith('[')):
-                tool_input = json.loads(input_str)
-            else:
-                tool_input = input_str
-        except:
-            tool_input = input_str
+        # Store the input parameters to provide more descriptive messages for the frontend,
+        # parsing the input as JSON if it's a string representation of JSON
+        tool_input = _parse_json_text(input_str)
             
         await self._safe_stream({
             "type": "tool_start", 
@@ -382,20 +588,19 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
         self, output: str, **kwargs: Any
     ) -> None:
         """Run when tool ends running"""
-        # Log details for debugging
-        print(f"[DEBUG CRITICAL] Tool end kwargs: {json.dumps(kwargs, default=str)}")
+        # Log details for debugging (serialized only when debug logging is on)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Tool end kwargs: %s", _to_json(kwargs))
         
         # Enhanced tool name extraction - following same logic as in on_tool_start
-        tool_name = None
-        
         # First check kwargs
-        if "name" in kwargs:
-            tool_name = kwargs["name"]
+        called_name = kwargs.get("name")
+        tool_name = called_name
         
         # If missing, try other sources or fallbacks
         if not tool_name:
             # Check invocation_params if available
-            invocation_params = kwargs.get("invocation_params", {})
+            invocation_params = kwargs.get("invocation_params") or {}
             if isinstance(invocation_params, dict):
                 tool_name = invocation_params.get("name")
         
@@ -403,20 +608,15 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
         if not tool_name:
             tool_name = "unknown_tool"
             
-        print(f"[DEBUG CRITICAL] Tool end extracted name: {tool_name}")
+        logger.debug("Tool end extracted name: %s", tool_name)
         
         # Try to parse output as JSON if it's a string representation of JSON
-        try:
-            if isinstance(output, str) and (output.startswith('{') or output.startswith('[')):
-                parsed_output = json.loads(output)
-            else:
-                parsed_output = output
-        except:
-            parsed_output = output
+        parsed_output = _parse_json_text(output)
         
         # Debug output to see what the tools are returning
-        print(f"[DEBUG CRITICAL] Tool output type: {type(parsed_output)}")
-        print(f"[DEBUG CRITICAL] Tool output sample: {json.dumps(parsed_output, default=str)[:300]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Tool output type: %s", type(parsed_output))
+            logger.debug("Tool output sample: %.300s", _to_json(parsed_output))
         
         # Check if output contains an error message and send it as tool_error
         is_error = False
@@ -435,264 +635,42 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
         # These are special structured data types that need explicit handling
         if isinstance(parsed_output, dict) and "type" in parsed_output:
             if parsed_output["type"] in ["order_details", "refund_status"] and "data" in parsed_output:
-                print(f"[DEBUG CRITICAL] Found direct {parsed_output['type']} - creating structured data event")
+                logger.debug("Found direct %s - creating structured data event", parsed_output['type'])
                 # Direct emission as structured data
                 await self._safe_stream({
                     "type": "structured_data",
                     "data": parsed_output
                 })
-                print(f"[DEBUG CRITICAL] Emitted {parsed_output['type']} structured data")
+                logger.debug("Emitted %s structured data", parsed_output['type'])
                 
                 # We still want to send the tool_end event, so don't return early
         
         if not is_error:
             # Forward any structured data in the output as separate events
             if isinstance(parsed_output, dict):
-                # Initialize collections for structured data
-                restaurant_results = []
-                food_item_results = []
-                
                 # Determine if this is a restaurant or food item search based on tool name
-                is_restaurant_search = kwargs.get("name") in ["search_restaurants", "search_restaurants_direct"]
-                is_food_search = kwargs.get("name") in ["search_food_items", "get_restaurant_menu"]
+                is_restaurant_search = called_name in _RESTAURANT_TOOLS
+                is_food_search = called_name in _FOOD_TOOLS
                 
-                print(f"[DEBUG] Tool type detection: restaurant_search={is_restaurant_search}, food_search={is_food_search}")
+                logger.debug("Tool type detection: restaurant_search=%s, food_search=%s", is_restaurant_search, is_food_search)
                 
-                # Case 1: Process results array if present
-                if "results" in parsed_output and isinstance(parsed_output["results"], list):
-                    print(f"[DEBUG CRITICAL] Found results array in tool output: {len(parsed_output.get('results', []))}")
-                    
-                    # Process results with type awareness
-                    if "results" in parsed_output and isinstance(parsed_output["results"], list):
-                        results = parsed_output["results"]
-                        print(f"[DEBUG] Processing {len(results)} results from tool output")
-                        
-                        for result in results:
-                            # Skip non-dict results
-                            if not isinstance(result, dict):
-                                continue
-                                
-                            print(f"[DEBUG] Processing result item: {json.dumps(result)[:150]}...")
-                            
-                            # Case 1: Already properly formatted with type/data
-                            if result.get("type") and result.get("data"):
-                                if result["type"] == "restaurant":
-                                    restaurant_results.append(result)
-                                    print(f"[DEBUG] Added well-formed restaurant: {result.get('data', {}).get('name', 'Unknown')}")
-                                elif result["type"] == "food_item":
-                                    food_item_results.append(result)
-                                    print(f"[DEBUG] Added well-formed food item: {result.get('data', {}).get('name', 'Unknown')}")
-                                    
-                            # Case 2: Nested data structure
-                            elif "data" in result and isinstance(result["data"], dict):
-                                item_data = result["data"]
-                                
-                                # Check restaurant properties
-                                if (is_restaurant_search or 
-                                    ("name" in item_data and ("rating" in item_data or "cuisine" in item_data))):
-                                    restaurant_card = {
-                                        "type": "restaurant",
-                                        "data": item_data
-                                    }
-                                    restaurant_results.append(restaurant_card)
-                                    print(f"[DEBUG] Added restaurant from nested data: {item_data.get('name', 'Unknown')}")
-                                
-                                # Check food item properties
-                                elif (is_food_search or 
-                                      ("name" in item_data and ("price" in item_data or "description" in item_data))):
-                                    food_card = {
-                                        "type": "food_item",
-                                        "data": item_data
-                                    }
-                                    food_item_results.append(food_card)
-                                    print(f"[DEBUG] Added food item from nested data: {item_data.get('name', 'Unknown')}")
-                            
-                            # Case 3: Direct data (flat structure)
-                            else:
-                                # Restaurant detection
-                                if (is_restaurant_search or 
-                                    ("name" in result and ("rating" in result or "cuisine" in result))):
-                                    restaurant_card = {
-                                        "type": "restaurant",
-                                        "data": result
-                                    }
-                                    restaurant_results.append(restaurant_card)
-                                    print(f"[DEBUG] Added restaurant from direct data: {result.get('name', 'Unknown')}")
-                                
-                                # Food item detection
-                                elif (is_food_search or 
-                                      ("name" in result and ("price" in result or "description" in result or "cost" in result))):
-                                    food_card = {
-                                        "type": "food_item",
-                                        "data": result
-                                    }
-                                    food_item_results.append(food_card)
-                                    print(f"[DEBUG] Added food item from direct data: {result.get('name', 'Unknown')}")
-                    
-                    # First emit all restaurant results if any
-                    print(f"[DEBUG] Emitting {len(restaurant_results)} restaurant cards")
-                    for restaurant in restaurant_results:
-                        # Double check proper structure before sending
-                        if restaurant.get("type") == "restaurant" and restaurant.get("data"):
-                            print(f"[DEBUG] Sending restaurant card: {json.dumps(restaurant)[:100]}...")
-                            await self._safe_stream({
-                                "type": "structured_data",
-                                "data": restaurant
-                            })
-                    
-                    # Then emit all food item results if any
-                    print(f"[DEBUG] Emitting {len(food_item_results)} food item cards")
-                    for food_item in food_item_results:
-                        # Double check proper structure before sending
-                        if food_item.get("type") == "food_item" and food_item.get("data"):
-                            print(f"[DEBUG] Sending food item card: {json.dumps(food_item)[:100]}...")
-                            await self._safe_stream({
-                                "type": "structured_data",
-                                "data": food_item
-                            })
+                # Cards are emitted as they are extracted, so the first one reaches
+                # the client before the rest of the output has been walked
+                debug_enabled = logger.isEnabledFor(logging.DEBUG)
+                card_count = 0
+                for card in _iter_cards(parsed_output, is_restaurant_search, is_food_search):
+                    # Skip cards an earlier tool call in this run already sent
+                    if not _is_new_card(self._seen_cards, card):
+                        continue
+                    if debug_enabled:
+                        logger.debug("Sending %s card: %.100s...", card["type"], _to_json(card))
+                    await self._safe_stream({
+                        "type": "structured_data",
+                        "data": card
+                    })
+                    card_count += 1
                 
-                # Case 2: Process menu structure from get_restaurant_menu tool
-                elif "menu" in parsed_output and isinstance(parsed_output["menu"], list):
-                    print(f"[DEBUG CRITICAL] Found menu array with {len(parsed_output['menu'])} categories")
-                    print(f"[DEBUG CRITICAL] Full parsed_output keys: {list(parsed_output.keys())}")
-                    restaurant_name = parsed_output.get("restaurant_name", "Restaurant")
-                    restaurant_id = parsed_output.get("restaurant_id", "unknown")
-                    
-                    # Check for the presence of results
-                    if "results" in parsed_output:
-                        print(f"[DEBUG CRITICAL] Found 'results' field with {len(parsed_output['results'])} items")
-                    else:
-                        print(f"[DEBUG CRITICAL] No 'results' field found in get_restaurant_menu output")
-                        
-                    # DEBUG: Print the first few menu items
-                    if parsed_output["menu"] and len(parsed_output["menu"]) > 0:
-                        first_category = parsed_output["menu"][0]
-                        print(f"[DEBUG] First menu category: {first_category.get('category', 'Unknown')}")
-                        if "items" in first_category and len(first_category["items"]) > 0:
-                            print(f"[DEBUG] Sample item: {json.dumps(first_category['items'][0])[:150]}...")
-                    
-                    # First emit restaurant info as a separate structured_data event
-                    if parsed_output.get("restaurant_info"):
-                        restaurant_card = {
-                            "type": "restaurant",
-                            "data": parsed_output["restaurant_info"]
-                        }
-                        restaurant_results.append(restaurant_card)
-                        print(f"[DEBUG] Added restaurant info from menu response: {restaurant_name}")
-                        
-                        # IMPORTANT: Explicitly emit this card right away
-                        await self._safe_stream({
-                            "type": "structured_data",
-                            "data": restaurant_card
-                        })
-                    
-                    # Always emit some restaurant info even if restaurant_info is missing
-                    if not parsed_output.get("restaurant_info"):
-                        basic_restaurant = {
-                            "type": "restaurant",
-                            "data": {
-                                "name": restaurant_name,
-                                "id": restaurant_id,
-                                "cuisine": ["Fast Food", "Burgers"],
-                                "menu_available": True
-                            }
-                        }
-                        restaurant_results.append(basic_restaurant)
-                        print(f"[DEBUG] Created basic restaurant card: {restaurant_name}")
-                        
-                        # Emit basic restaurant card
-                        await self._safe_stream({
-                            "type": "structured_data",
-                            "data": basic_restaurant
-                        })
-                    
-                    # Extract featured/popular items
-                    if parsed_output.get("featured_items") and isinstance(parsed_output["featured_items"], list):
-                        print(f"[DEBUG] Processing {len(parsed_output['featured_items'])} featured items")
-                        for item in parsed_output["featured_items"]:
-                            food_card = {
-                                "type": "food_item",
-                                "data": {
-                                    **item,
-                                    "restaurant_name": restaurant_name,
-                                    "restaurant_id": restaurant_id,
-                                    "featured": True
-                                }
-                            }
-                            food_item_results.append(food_card)
-                            print(f"[DEBUG] Added featured item: {item.get('name', 'Unknown')}")
-                            
-                            # Emit this card right away
-                            await self._safe_stream({
-                                "type": "structured_data",
-                                "data": food_card
-                            })
-                    
-                    # Always process menu categories regardless of tool type
-                    menu_item_count = 0
-                    for category in parsed_output["menu"]:
-                        category_name = category.get("category", "Menu Items")
-                        print(f"[DEBUG] Processing category: {category_name}")
-                        
-                        if "items" in category and isinstance(category["items"], list):
-                            # Limit to 3 items per category to avoid overwhelming the UI
-                            for idx, item in enumerate(category["items"]):
-                                if idx >= 3:  # Only process first 3 items per category
-                                    break
-                                    
-                                # Add restaurant context to the food item
-                                food_card = {
-                                    "type": "food_item",
-                                    "data": {
-                                        **item,
-                                        "restaurant_name": restaurant_name,
-                                        "restaurant_id": restaurant_id,
-                                        "category": category_name
-                                    }
-                                }
-                                food_item_results.append(food_card)
-                                menu_item_count += 1
-                                
-                                # Emit this card right away
-                                await self._safe_stream({
-                                    "type": "structured_data",
-                                    "data": food_card
-                                })
-                                
-                    print(f"[DEBUG] Processed {menu_item_count} total menu items")
-                
-                # Case 3: Direct object is a restaurant
-                elif "name" in parsed_output and ("rating" in parsed_output or "cuisine" in parsed_output):
-                    print(f"[DEBUG] Found direct restaurant data")
-                    restaurant_card = {"type": "restaurant", "data": parsed_output}
-                    restaurant_results.append(restaurant_card)
-                
-                # Case 4: Direct object is a food item
-                elif "name" in parsed_output and ("price" in parsed_output or "description" in parsed_output):
-                    print(f"[DEBUG] Found direct food item data")
-                    food_item_card = {"type": "food_item", "data": parsed_output}
-                    food_item_results.append(food_item_card)
-                
-                # Emit all structured data as separate events
-                print(f"[DEBUG] Emitting structured data: {len(restaurant_results)} restaurants, {len(food_item_results)} food items")
-                
-                # First emit restaurant cards
-                for restaurant in restaurant_results:
-                    if restaurant.get("type") == "restaurant" and restaurant.get("data"):
-                        print(f"[DEBUG] Sending restaurant card: {json.dumps(restaurant)[:100]}...")
-                        await self._safe_stream({
-                            "type": "structured_data",
-                            "data": restaurant
-                        })
-                
-                # Then emit food item cards
-                for food_item in food_item_results:
-                    if food_item.get("type") == "food_item" and food_item.get("data"):
-                        print(f"[DEBUG] Sending food item card: {json.dumps(food_item)[:100]}...")
-                        await self._safe_stream({
-                            "type": "structured_data",
-                            "data": food_item
-                        })
+                logger.debug("Emitted %d structured data cards", card_count)
             
             await self._safe_stream({
                 "type": "tool_end", 
@@ -709,11 +687,8 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
         error_msg = str(error)
         
         # Log detailed error information to help with debugging
-        print(f"Tool Error in {tool_name}: {error_msg}")
-        print(f"Tool Error type: {type(error).__name__}")
-        if hasattr(error, "__traceback__"):
-            import traceback
-            traceback.print_tb(error.__traceback__)
+        logger.error("Tool Error in %s (%s): %s", tool_name, type(error).__name__, error_msg,
+                     exc_info=(type(error), error, error.__traceback__))
         
         await self._safe_stream({
             "type": "tool_error", 
@@ -768,3 +743,38 @@ class StreamingToolsCallbackHandler(AsyncCallbackHandler):
             "type": "agent_finish", 
             "data": "Agent has completed its reasoning"
         })
+
+
+class RepeatedToolCallError(Exception):
+    """Raised when an agent run repeats a tool call it has already made"""
+    
+    def __init__(self, tool: str):
+        super().__init__(f"Repeated call to {tool} with the same input")
+        self.tool = tool
+
+
+class ToolLoopGuardHandler(AsyncCallbackHandler):
+    """Stops an agent run as soon as it repeats an identical search or menu lookup
+    
+    Only idempotent lookups are guarded: repeating one returns the same result,
+    so it means the agent is looping. Order and refund workflow tools read or
+    change state that moves during a run and may legitimately be called again
+    with the same input. Use one handler per run.
+    """
+    
+    # Let the exception abort the run instead of being logged and ignored
+    raise_error = True
+    
+    def __init__(self):
+        super().__init__()
+        self._seen_calls = set()
+    
+    async def on_agent_action(self, action, **kwargs: Any) -> None:
+        """Record a lookup, raising RepeatedToolCallError if it was already made"""
+        if action.tool not in ResponseCache.CACHEABLE_TOOLS:
+            return
+        call = (action.tool, repr(action.tool_input))
+        if call in self._seen_calls:
+            logger.warning("Stopping agent run: repeated call to %s", action.tool)
+            raise RepeatedToolCallError(action.tool)
+        self._seen_calls.add(call)
@@ -4,20 +4,37 @@ Bedrock client setup for LangChain integration with multimodal support
 import os
 import boto3
 import base64
+import functools
 import logging
 import mimetypes
 from urllib.parse import urlparse
-from typing import Dict, List, Optional, Union, Any
+from typing import Dict, List, Optional, Tuple, Union, Any
+import io
 import httpx
+from botocore.config import Config
 
 from langchain_aws import ChatBedrock
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; images are then sent as uploaded
+    Image = None
+
 # Set up logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Uploaded images are downscaled to this long edge and re-encoded as JPEG before
+# being sent to Claude; refund and prescription checks don't need more detail
+MAX_IMAGE_EDGE = 1024
+IMAGE_JPEG_QUALITY = 85
+
+# ChatBedrock calls boto3 synchronously, so each in-flight agent step holds a
+# worker thread and an HTTP connection; both pools are sized to this
+BEDROCK_MAX_CONCURRENCY = 64
+
 class BedrockClientSetup:
     """Handles the setup and configuration of Amazon Bedrock client with multimodal support"""
     
@@ -39,6 +56,7 @@ class BedrockClientSetup:
         bedrock_runtime = boto3.client(
             service_name="bedrock-runtime",
             region_name="us-west-2",
+            config=Config(max_pool_connections=BEDROCK_MAX_CONCURRENCY),
             # aws_access_key_id=aws_access_key_id,
             # aws_secret_access_key=aws_secret_access_key,
             # aws_session_token=aws_session_token
@@ -50,7 +68,8 @@ class BedrockClientSetup:
     def get_llm(
         #model_id="anthropic.claude-3-5-sonnet-20241022-v2:0", 
         model_id="us.anthropic.claude-3-7-sonnet-20250219-v1:0", 
-        temperature=0.0
+        temperature=0.0,
+        cache=None
         ):
         """
         Initialize the LLM for use with LangChain.
@@ -58,6 +77,7 @@ class BedrockClientSetup:
         Args:
             model_id: Bedrock model identifier, defaults to Claude 3 Sonnet
             temperature: Sampling temperature, higher is more creative
+            cache: Optional LangChain cache for this model's generations
             
         Returns:
             Configured LLM instance
@@ -67,6 +87,7 @@ class BedrockClientSetup:
         llm = ChatBedrock(
             client=bedrock_client,
             model_id=model_id,
+            cache=cache,
             model_kwargs={
                 "temperature": temperature,
                 "max_tokens": 4096,
@@ -122,6 +143,86 @@ Think step-by-step before providing a final answer. Use the available tools when
         
         return prompt
     
+    @staticmethod
+    def downscale_image(image_bytes: bytes) -> Optional[bytes]:
+        """
+        Shrink an image to MAX_IMAGE_EDGE and re-encode it as JPEG
+        
+        Args:
+            image_bytes: Raw image bytes
+            
+        Returns:
+            JPEG bytes if that is smaller than the original, otherwise None
+        """
+        if Image is None:
+            return None
+        
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+                buffer = io.BytesIO()
+                image.save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        except Exception as e:
+            logger.warning(f"Could not downscale image, sending original: {e}")
+            return None
+        
+        jpeg_bytes = buffer.getvalue()
+        if len(jpeg_bytes) >= len(image_bytes):
+            return None
+        
+        logger.debug("Downscaled image from %d to %d bytes", len(image_bytes), len(jpeg_bytes))
+        return jpeg_bytes
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def _prepare_base64_image(base64_data: str, media_type: str) -> Tuple[str, str]:
+        """
+        Decode a base64 image and downscale it when that makes it smaller
+        
+        Memoized on the encoded data, so an upload that several tools send to
+        Claude (or that is re-sent on a later turn) is only decoded and
+        re-encoded once.
+        
+        Args:
+            base64_data: Base64 encoded image
+            media_type: MIME type of the image
+            
+        Returns:
+            (media_type, base64_data) to send to Claude
+            
+        Raises:
+            binascii.Error: If base64_data is not valid base64
+        """
+        image_bytes = base64.b64decode(base64_data)
+        downscaled = BedrockClientSetup.downscale_image(image_bytes)
+        if downscaled is None:
+            return media_type, base64_data
+        return "image/jpeg", base64.b64encode(downscaled).decode("utf-8")
+    
+    @staticmethod
+    def _base64_image_part(base64_data: str, media_type: str) -> Dict[str, Any]:
+        """
+        Build a Claude image block from base64 image data
+        
+        Args:
+            base64_data: Base64 encoded image
+            media_type: MIME type of the image
+            
+        Returns:
+            Image content block for Claude's multimodal API
+        """
+        media_type, base64_data = BedrockClientSetup._prepare_base64_image(base64_data, media_type)
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": base64_data
+            }
+        }
+
     @staticmethod
     def format_image_for_claude(image_data: str) -> Dict[str, Any]:
         """
@@ -140,22 +241,13 @@ Think step-by-step before providing a final answer. Use the available tools when
                 # Format is typically: data:image/jpeg;base64,<actual_base64_data>
                 _, base64_part = image_data.split(";base64,", 1)
                 
-                # Validate the base64 data
+                # For Claude, we need to use the 'base64' format instead of data URI
+                # (decoding also validates the base64 data)
                 try:
-                    base64.b64decode(base64_part)
+                    return BedrockClientSetup._base64_image_part(base64_part, "image/jpeg")
                 except:
                     logger.error("Invalid base64 data in data URI")
                     return None
-                
-                # For Claude, we need to use the 'base64' format instead of data URI
-                return {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": base64_part
-                    }
-                }
             
             # Check if it's a URL
             try:
@@ -174,8 +266,12 @@ Think step-by-step before providing a final answer. Use the available tools when
                             if not content_type or not content_type.startswith("image/"):
                                 content_type = mimetypes.guess_type(image_data)[0] or "image/jpeg"
                             
-                            # Convert to base64
+                            # Downscale before converting to base64
                             image_bytes = response.content
+                            downscaled = BedrockClientSetup.downscale_image(image_bytes)
+                            if downscaled is not None:
+                                image_bytes = downscaled
+                                content_type = "image/jpeg"
                             image_b64 = base64.b64encode(image_bytes).decode("utf-8")
                             
                             # Return in Claude's expected format
@@ -199,18 +295,8 @@ Think step-by-step before providing a final answer. Use the available tools when
                 # Clean the input if it has any whitespace or newlines
                 cleaned_data = ''.join(image_data.split())
                 
-                # Try to decode to validate it's proper base64
-                base64.b64decode(cleaned_data)
-                
-                # Return in Claude's expected format
-                return {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": cleaned_data
-                    }
-                }
+                # Return in Claude's expected format (decoding validates it's proper base64)
+                return BedrockClientSetup._base64_image_part(cleaned_data, "image/jpeg")
             except:
                 logger.error("Invalid image data format - not valid base64")
                 return None
@@ -240,18 +326,9 @@ Think step-by-step before providing a final answer. Use the available tools when
         for image_data in images:
             image_part = BedrockClientSetup.format_image_for_claude(image_data)
             if image_part:
-                # Debug the image format
-                logger.info(f"Adding image part with type: {image_part.get('type')}")
+                logger.debug("Adding image part with %d base64 chars", len(image_part["source"]["data"]))
                 message_parts.append(image_part)
         
-        # Log the final message structure (without full image data)
-        debug_message = []
-        for part in message_parts:
-            if part.get('type') == 'text':
-                debug_message.append({'type': 'text', 'text': part.get('text')[:50] + '...' if len(part.get('text', '')) > 50 else part.get('text')})
-            else:
-                debug_message.append({'type': part.get('type')})
-                
-        logger.info(f"Created multimodal message with {len(message_parts)} parts: {debug_message}")
+        logger.info("Created multimodal message with %d parts", len(message_parts))
         
         return message_parts
@@ -0,0 +1,14 @@
+"""
+Per-request state shared between the chatbot agent and its tools.
+
+Values are set inside the task that runs the agent for a request, so
+concurrent requests on the shared agent each see their own.
+"""
+from contextvars import ContextVar
+from typing import Optional
+
+# Image uploaded with the current message; tools accept 'current_image' to use it
+CURRENT_IMAGE: ContextVar[Optional[str]] = ContextVar("current_image", default=None)
+
+# Conversation the current message belongs to
+CURRENT_CONVERSATION_ID: ContextVar[Optional[str]] = ContextVar("current_conversation_id", default=None)
@@ -2,9 +2,14 @@
 Memory management for the chatbot agent, including per-conversation memory.
 """
 
+import logging
+
 from langchain.memory import ConversationBufferMemory
 from langchain_core.messages import AIMessage, HumanMessage
 
+# Set up logging
+logger = logging.getLogger(__name__)
+
 class ConversationMemoryManager:
     """
     Memory manager that maintains a separate memory instance for each conversation.
@@ -20,7 +25,7 @@ class ConversationMemoryManager:
         """
         self.window_size = window_size
         self.memories = {}
-        print(f"ConversationMemoryManager initialized with window size {window_size}")
+        logger.info("ConversationMemoryManager initialized with window size %d", window_size)
     
     def get_memory(self, conversation_id):
         """
@@ -37,24 +42,36 @@ class ConversationMemoryManager:
             conversation_id = "default"
             
         if conversation_id not in self.memories:
-            print(f"Creating new memory for conversation {conversation_id}")
+            logger.debug("Creating new memory for conversation %s", conversation_id)
             self.memories[conversation_id] = ConversationBufferMemory(
                 memory_key="chat_history",
                 input_key="human_input",
                 return_messages=True
             )
-        else:
-            # Debug existing memory
-            memory = self.memories[conversation_id]
-            history = memory.chat_memory.messages
-            print(f"[DEBUG MEMORY] Found existing memory for {conversation_id} with {len(history)} messages:")
+        elif logger.isEnabledFor(logging.DEBUG):
+            # Debug existing memory (walks the whole history, so only when asked for)
+            history = self.memories[conversation_id].chat_memory.messages
+            logger.debug("[MEMORY] Found existing memory for %s with %d messages:", conversation_id, len(history))
             for idx, msg in enumerate(history):
                 msg_type = "USER" if isinstance(msg, HumanMessage) else "AI"
-                content_preview = str(msg.content)[:50] + "..." if len(str(msg.content)) > 50 else str(msg.content)
-                print(f"[DEBUG MEMORY] Message {idx}: {msg_type} - {content_preview}")
+                content = str(msg.content)
+                content_preview = content[:50] + "..." if len(content) > 50 else content
+                logger.debug("[MEMORY] Message %d: %s - %s", idx, msg_type, content_preview)
             
         return self.memories[conversation_id]
     
+    def _trim(self, memory):
+        """
+        Drop messages that have fallen out of the window, in place
+        
+        Args:
+            memory: ConversationBufferMemory to trim
+        """
+        messages = memory.chat_memory.messages
+        overflow = len(messages) - self.window_size * 2
+        if overflow > 0:
+            del messages[:overflow]
+    
     def add_user_message(self, conversation_id, message):
         """
         Add a user message to a conversation memory
@@ -65,6 +82,7 @@ class ConversationMemoryManager:
         """
         memory = self.get_memory(conversation_id)
         memory.chat_memory.add_user_message(message)
+        self._trim(memory)
         
     def add_ai_message(self, conversation_id, message):
         """
@@ -76,6 +94,21 @@ class ConversationMemoryManager:
         """
         memory = self.get_memory(conversation_id)
         memory.chat_memory.add_ai_message(message)
+        self._trim(memory)
+    
+    def add_turn(self, conversation_id, user_message, ai_message):
+        """
+        Add a user message and the AI reply to a conversation memory in one call
+        
+        Args:
+            conversation_id: Conversation identifier
+            user_message: User message text
+            ai_message: AI message text
+        """
+        memory = self.get_memory(conversation_id)
+        memory.chat_memory.add_user_message(user_message)
+        memory.chat_memory.add_ai_message(ai_message)
+        self._trim(memory)
     
     def get_chat_history(self, conversation_id):
         """
@@ -101,7 +134,7 @@ class ConversationMemoryManager:
         if conversation_id:
             if conversation_id in self.memories:
                 self.memories[conversation_id].clear()
-                print(f"Cleared memory for conversation {conversation_id}")
+                logger.info("Cleared memory for conversation %s", conversation_id)
         else:
             self.memories = {}
-            print("Cleared all conversation memories")
+            logger.info("Cleared all conversation memories")
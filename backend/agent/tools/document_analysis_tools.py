@@ -10,6 +10,8 @@ from typing import Dict, Any, Optional, List, Union
 from langchain_core.tools import tool
 from langchain_core.messages import HumanMessage, SystemMessage
 
+from ..context import CURRENT_IMAGE
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -31,96 +33,15 @@ def analyze_medical_document(image_data_param: str, doc_type: str = "prescriptio
     """
     logger.info(f"Analyzing medical document of type: {doc_type}")
     
-    # Import for getting access to agent
-    import importlib
-    import sys
-    
-    # Check if we need to get the image from the agent's global state
+    # Check if we need to get the image uploaded with the current message
     image_data = image_data_param
     if image_data == 'current_image' or not image_data:
-        try:
-            # Try to access the agent instance to get the current image data
-            # First, try to access the agent instance through direct module access
-            agent_mod = sys.modules.get('backend.agent.agent', None)
-            logger.info(f"Looking for agent module for image data: found={agent_mod is not None}")
-            
-            # Method 1: Search for ChatbotAgent instance in the module
-            if agent_mod:
-                logger.debug("Searching for agent instance with _current_image_data")
-                
-                # Look for classes that might be the agent
-                agent_found = False
-                for attr_name in dir(agent_mod):
-                    if attr_name.startswith('__'):  # Skip dunder methods
-                        continue
-                    
-                    try:
-                        attr = getattr(agent_mod, attr_name)
-                        logger.debug(f"Checking attribute: {attr_name} (type={type(attr)})")
-                        
-                        # Check if this is an instance with our needed attribute
-                        if hasattr(attr, '_current_image_data'):
-                            agent_instance = attr
-                            logger.info(f"Found agent instance: {attr_name}")
-                            agent_found = True
-                            
-                            if agent_instance._current_image_data:
-                                image_data = agent_instance._current_image_data
-                                logger.info("Successfully retrieved image data from agent state")
-                                break
-                            else:
-                                logger.warning("Agent instance found but _current_image_data is None/empty")
-                    except Exception as attr_err:
-                        logger.debug(f"Error accessing attribute {attr_name}: {str(attr_err)}")
-                
-                if not agent_found:
-                    logger.warning("No agent instance with _current_image_data found")
-            
-            # Method 2: Try to get all instances of ChatbotAgent
-            if not image_data or image_data == 'current_image':
-                logger.debug("Trying secondary method to find ChatbotAgent instances")
-                
-                try:
-                    from backend.agent.agent import ChatbotAgent
-                    import gc
-                    
-                    # Find all instances of ChatbotAgent
-                    agent_instances = [obj for obj in gc.get_objects() if isinstance(obj, ChatbotAgent)]
-                    logger.info(f"Found {len(agent_instances)} ChatbotAgent instances")
-                    
-                    for agent in agent_instances:
-                        if hasattr(agent, '_current_image_data') and agent._current_image_data:
-                            image_data = agent._current_image_data
-                            logger.info("Retrieved image data from ChatbotAgent instance via gc")
-                            break
-                except Exception as gc_err:
-                    logger.warning(f"Error finding ChatbotAgent instances: {str(gc_err)}")
-            
-            # Method 3: As a last resort, scan all global objects for _current_image_data
-            if not image_data or image_data == 'current_image':
-                logger.debug("Trying last-resort method to scan globals")
-                try:
-                    import gc
-                    for obj in gc.get_objects():
-                        if hasattr(obj, '_current_image_data') and obj._current_image_data:
-                            image_data = obj._current_image_data
-                            logger.info(f"Found image data on object of type {type(obj)}")
-                            break
-                except Exception as scan_err:
-                    logger.warning(f"Error scanning global objects: {str(scan_err)}")
-            
-            # If we still don't have the image, log an error
-            if not image_data or image_data == 'current_image':
-                logger.error("Failed to retrieve image data from agent state using multiple methods")
-                return {
-                    "error": "No image data provided",
-                    "message": "Image data is required for document analysis but was not provided"
-                }
-        except Exception as e:
-            logger.error(f"Error accessing agent image data: {str(e)}")
+        image_data = CURRENT_IMAGE.get()
+        if not image_data:
+            logger.error("No image uploaded with the current message")
             return {
-                "error": "Failed to access image data",
-                "message": str(e)
+                "error": "No image data provided",
+                "message": "Image data is required for document analysis but was not provided"
             }
     
     try:
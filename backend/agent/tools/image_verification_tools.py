@@ -10,6 +10,8 @@ import logging
 from langchain_core.tools import tool
 from langchain.pydantic_v1 import BaseModel, Field
 
+from ..context import CURRENT_IMAGE
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -42,39 +44,15 @@ def verify_refund_image(image_data_param: str, order_details: Dict[str, Any], re
     """
     logger.info(f"Verifying refund image for reason: {reason}")
 
-    # Import for getting access to agent
-    import importlib
-    import sys
-    
-    # Check if we need to get the image from the agent's global state
+    # Check if we need to get the image uploaded with the current message
     image_data = image_data_param
     if image_data == 'current_image' or not image_data:
-        try:
-            # Try to access the agent instance to get the current image data
-            # This is a bit of a hack, but it works to connect the tools with global state
-            agent_mod = sys.modules.get('backend.agent.agent', None)
-            if agent_mod:
-                for attr_name in dir(agent_mod):
-                    attr = getattr(agent_mod, attr_name)
-                    if hasattr(attr, '_current_image_data'):
-                        agent_instance = attr
-                        if agent_instance._current_image_data:
-                            image_data = agent_instance._current_image_data
-                            logger.info("Successfully retrieved image data from agent state")
-                            break
-            
-            # If we couldn't get the image, log an error
-            if not image_data or image_data == 'current_image':
-                logger.error("Failed to retrieve image data from agent state")
-                return {
-                    "error": "No image data provided",
-                    "message": "Image data is required for verification but was not provided"
-                }
-        except Exception as e:
-            logger.error(f"Error accessing agent image data: {str(e)}")
+        image_data = CURRENT_IMAGE.get()
+        if not image_data:
+            logger.error("No image uploaded with the current message")
             return {
-                "error": "Failed to access image data",
-                "message": str(e)
+                "error": "No image data provided",
+                "message": "Image data is required for verification but was not provided"
             }
     
     try:
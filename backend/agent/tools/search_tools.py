@@ -2,8 +2,11 @@
 Search-related tools for the LangChain agent
 Uses the SwiggyAPIClient for consistent API access
 """
+import asyncio
+import heapq
 import time
 import json
+import logging
 from typing import Dict, List, Any, Optional
 
 from langchain_core.tools import tool
@@ -12,6 +15,8 @@ from pymongo import MongoClient
 # Import the SwiggyAPIClient
 from ...services.swiggy_api_client import SwiggyAPIClient
 
+logger = logging.getLogger(__name__)
+
 # MongoDB setup for user preferences
 client = MongoClient("mongodb://localhost:27017/")
 db = client["restaurant_db"]
@@ -266,6 +271,10 @@ async def search_restaurants_direct(query: str) -> Dict[str, Any]:
             "suggestions": ["Please try again later", "Try with a different search term"]
         }
 
+def _relevance_score(item: Dict[str, Any]) -> float:
+    """Sort key for food item results"""
+    return item["data"]["relevance_score"]
+
 @tool
 async def search_food_items_enhanced(query: str) -> Dict[str, Any]:
     """
@@ -616,18 +625,10 @@ async def search_food_items_enhanced(query: str) -> Dict[str, Any]:
                     }
                 
                 # Add relevance score to item for easier sorting
-                relevance = item["data"].get("relevance_score", 0)
-                item["data"]["relevance_score"] = relevance
+                item["data"].setdefault("relevance_score", 0)
                 
                 restaurants_with_items[rest_id]["items"].append(item)
         
-        # Sort items within each restaurant by relevance
-        for rest_id, restaurant_data in restaurants_with_items.items():
-            restaurant_data["items"].sort(
-                key=lambda item: item["data"].get("relevance_score", 0),
-                reverse=True
-            )
-        
         # If no results were found, provide fallback results for common food categories
         if not results:
             print(f"[DEBUG] No results found, checking if fallback items available for {search_term}")
@@ -723,7 +724,9 @@ async def search_food_items_enhanced(query: str) -> Dict[str, Any]:
                 {
                     "id": rest_id,
                     "name": data["name"],
-                    "items": data["items"][:3]  # Limit to top 3 items per restaurant
+                    # Top 3 items per restaurant by relevance; a partial selection
+                    # rather than sorting every item when only 3 are kept
+                    "items": heapq.nlargest(3, data["items"], key=_relevance_score)
                 }
                 for rest_id, data in restaurants_with_items.items()
             ],
@@ -736,9 +739,7 @@ async def search_food_items_enhanced(query: str) -> Dict[str, Any]:
         }
             
     except Exception as e:
-        print(f"[DEBUG] Error in search_food_items_enhanced: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in search_food_items_enhanced: %s", e)
         return {
             "message": f"Error searching for food items: {str(e)}",
             "suggestions": ["Please try again later", "Try with a different search term"]
@@ -856,3 +857,49 @@ async def get_restaurant_menu(restaurant_id: str) -> Dict[str, Any]:
     except Exception as e:
         print(f"Error in get_restaurant_menu: {str(e)}")
         return {"error": "Error fetching restaurant menu", "message": str(e)}
+
+# Upper bound on menus fetched by one bulk call, to keep the tool output
+# within a reasonable token budget
+MAX_BULK_MENUS = 5
+
+@tool
+async def get_restaurant_menus_bulk(restaurant_ids: List[str]) -> Dict[str, Any]:
+    """
+    Get the menus for several restaurants at once. Use this instead of repeated
+    get_restaurant_menu calls when you already have multiple restaurant IDs.
+    
+    Args:
+        restaurant_ids: IDs of the restaurants (up to 5)
+        
+    Returns:
+        Menu data for each restaurant, in the same format as get_restaurant_menu
+    """
+    # Drop duplicates while keeping the requested order
+    restaurant_ids = list(dict.fromkeys(restaurant_ids))[:MAX_BULK_MENUS]
+    
+    # Fetch all menus concurrently; the API client coalesces and caches them.
+    # Calls the tool's coroutine directly so the nested fetches don't emit
+    # their own tool callbacks into the stream
+    menus = await asyncio.gather(
+        *(get_restaurant_menu.coroutine(rest_id) for rest_id in restaurant_ids),
+        return_exceptions=True
+    )
+    
+    results = []
+    restaurant_menus = []
+    for rest_id, menu in zip(restaurant_ids, menus):
+        if isinstance(menu, Exception):
+            logger.error("Error fetching menu for restaurant %s: %s", rest_id, menu)
+            menu = {"error": "Error fetching restaurant menu", "message": str(menu)}
+        restaurant_menus.append({"restaurant_id": rest_id, **menu})
+        
+        # A restaurant card followed by a couple of its dishes per restaurant
+        if "error" not in menu:
+            results.append({"type": "restaurant", "data": menu["restaurant_info"]})
+            results.extend(menu["results"][:2])
+    
+    return {
+        "menus": restaurant_menus,
+        "results": results,
+        "result_type": "menus_bulk"
+    }
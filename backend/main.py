@@ -3,7 +3,11 @@ FastAPI backend for food delivery app chatbot
 """
 import aiohttp
 import asyncio
-import json
+import concurrent.futures
+import logging
+import logging.handlers
+import orjson
+import queue
 import uuid
 import time
 from datetime import datetime
@@ -18,12 +22,39 @@ from fastapi.middleware.cors import CORSMiddleware
 from pymongo import MongoClient
 
 # Import our chatbot agent
-from backend.agent.agent import ChatbotAgent
+from backend.agent.agent import get_agent
+from backend.agent.client import BEDROCK_MAX_CONCURRENCY
+
+# Log records are handed to a background thread, so writing tracebacks to
+# stderr from an except block never blocks the event loop
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)], force=True)
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def start_log_listener():
+    _log_listener.start()
+
+@app.on_event("startup")
+async def size_default_executor():
+    # Bedrock calls from agent_executor.ainvoke run on the default executor;
+    # its stock size would queue concurrent chats behind a few threads
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=BEDROCK_MAX_CONCURRENCY)
+    )
+
+@app.on_event("shutdown")
+async def stop_log_listener():
+    _log_listener.stop()
+
 # Initialize the chatbot agent
-chatbot = ChatbotAgent()
+chatbot = get_agent()
 
 app.add_middleware(
     CORSMiddleware,
@@ -85,7 +116,7 @@ async def create_order(order: Order):
         # Get the MongoDB ObjectId as string
         order_id = str(result.inserted_id)
         
-        print(f"Order created successfully with ID: {order_id}")
+        logger.info("Order created successfully with ID: %s", order_id)
         
         # Return order details
         return {
@@ -95,7 +126,7 @@ async def create_order(order: Order):
             "status": "Order Placed"
         }
     except Exception as e:
-        print(f"Error creating order: {str(e)}")
+        logger.exception("Error creating order: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/get_order/{order_id}")
@@ -121,7 +152,7 @@ async def get_order(order_id: str):
     except HTTPException as he:
         raise he
     except Exception as e:
-        print(f"Error retrieving order: {str(e)}")
+        logger.exception("Error retrieving order: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     
 
@@ -199,6 +230,10 @@ class ChatMessage(BaseModel):
     user_id: Optional[str] = None
     media: Optional[MediaData] = None
 
+def format_sse_event(payload: Dict[str, Any]) -> bytes:
+    """Serialize an event as an SSE data frame, ready to write to the response"""
+    return b"data: " + orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS) + b"\n\n"
+
 # Helper function to track messages in the frontend for UI purposes only
 def save_conversation_message(conversation_id: str, user_id: Optional[str], message_type: str, message: str):
     """Save a message to the in-memory conversation store (for UI only)"""
@@ -235,8 +270,8 @@ async def stream_chat_response(message: str, conversation_id: Optional[str], loc
     save_conversation_message(conversation_id, user_id, "human", message)
     
     # Log location data for debugging
-    print(f"Processing message with location data: {location}")
-    print(f"[DEBUG TRACE] Starting chat processing for message: {message[:50]}...")
+    logger.debug("Processing message with location data: %s", location)
+    logger.debug("[TRACE] Starting chat processing for message: %.50s...", message)
 
     # Create buffer for directly injecting structured data
     pending_structured_data = []
@@ -254,7 +289,7 @@ async def stream_chat_response(message: str, conversation_id: Optional[str], loc
         # Add debug logging to trace events
         if isinstance(chunk, dict):
             event_type = chunk.get("type", "unknown")
-            print(f"[DEBUG EVENT] Streaming event type: {event_type}")
+            logger.debug("[EVENT] Streaming event type: %s", event_type)
             
             # Collect the AI's final message
             if event_type == "message" and "data" in chunk:
@@ -264,22 +299,22 @@ async def stream_chat_response(message: str, conversation_id: Optional[str], loc
             if event_type == "tool_end" and "output" in chunk:
                 tool_name = chunk.get("tool_name", "unknown")
                 last_tool_name = tool_name
-                print(f"[DEBUG TOOL] Tool {tool_name} response received")
+                logger.debug("[TOOL] Tool %s response received", tool_name)
                 output = chunk.get("output", {})
                 
                 # Log detailed info for tool responses
                 if isinstance(output, dict):
                     if "results" in output:
-                        print(f"[DEBUG TOOL] Tool {tool_name} returned {len(output.get('results', []))} results")
+                        logger.debug("[TOOL] Tool %s returned %d results", tool_name, len(output.get("results", [])))
                     if "result_type" in output:
-                        print(f"[DEBUG TOOL] Tool {tool_name} result type: {output.get('result_type')}")
+                        logger.debug("[TOOL] Tool %s result type: %s", tool_name, output.get("result_type"))
                     
                     # CRITICAL: Direct structured data extraction for get_restaurant_menu tool
                     if tool_name == "get_restaurant_menu" and "restaurant_info" in output:
                         # Extract restaurant card
                         restaurant_info = output.get("restaurant_info")
                         if restaurant_info:
-                            print(f"[DEBUG CRITICAL DIRECT] Extracting restaurant card for direct injection")
+                            logger.debug("[DIRECT] Extracting restaurant card for direct injection")
                             
                             # Create restaurant card event
                             restaurant_event = {
@@ -292,14 +327,14 @@ async def stream_chat_response(message: str, conversation_id: Optional[str], loc
                             
                             # Add to pending structured data - will be sent immediately after this event
                             pending_structured_data.append(restaurant_event)
-                            print(f"[DEBUG CRITICAL DIRECT] Added restaurant card to pending structured data")
+                            logger.debug("[DIRECT] Added restaurant card to pending structured data")
                         
                         # Extract food items (up to 5 for menu display)
                         if "results" in output and isinstance(output["results"], list):
                             food_items = output["results"][:5]  # Limit to 5 items
                             for item in food_items:
                                 if isinstance(item, dict) and "type" in item and item["type"] == "food_item":
-                                    print(f"[DEBUG CRITICAL DIRECT] Extracting food item for direct injection")
+                                    logger.debug("[DIRECT] Extracting food item for direct injection")
                                     
                                     # Create food item event (directly use item as is)
                                     food_event = {
@@ -310,7 +345,7 @@ async def stream_chat_response(message: str, conversation_id: Optional[str], loc
                                     # Add to pending structured data
                                     pending_structured_data.append(food_event)
                             
-                            print(f"[DEBUG CRITICAL DIRECT] Added {len(food_items)} food items to pending structured data")
+                            logger.debug("[DIRECT] Added %d food items to pending structured data", len(food_items))
                     
                     # CRITICAL: Direct extraction for search_restaurants_direct tool
                     elif tool_name == "search_restaurants_direct" and "results" in output:
@@ -320,7 +355,7 @@ async def stream_chat_response(message: str, conversation_id: Optional[str], loc
                             if isinstance(item, dict):
                                 # Check if it's already formatted with type/data
                                 if "type" in item and item["type"] == "restaurant" and "data" in item:
-                                    print(f"[DEBUG CRITICAL DIRECT] Extracting restaurant result for direct injection")
+                                    logger.debug("[DIRECT] Extracting restaurant result for direct injection")
                                     
                                     # Create restaurant event
                                     restaurant_event = {
@@ -331,31 +366,30 @@ async def stream_chat_response(message: str, conversation_id: Optional[str], loc
                                     # Add to pending structured data
                                     pending_structured_data.append(restaurant_event)
                                     
-                        print(f"[DEBUG CRITICAL DIRECT] Added {len(restaurant_results)} restaurant results to pending structured data")
+                        logger.debug("[DIRECT] Added %d restaurant results to pending structured data", len(restaurant_results))
             
             # Extra logging for structured data 
             elif event_type == "structured_data":
-                print(f"[DEBUG CRITICAL] Found structured_data event")
-                data_type = chunk.get("data", {}).get("type", "unknown") if isinstance(chunk.get("data"), dict) else "unknown"
-                print(f"[DEBUG CRITICAL] Structured data type: {data_type}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    data_type = chunk.get("data", {}).get("type", "unknown") if isinstance(chunk.get("data"), dict) else "unknown"
+                    logger.debug("[STRUCTURED] Found structured_data event of type: %s", data_type)
         
         # Format each chunk as an SSE event
-        formatted_chunk = f"data: {json.dumps(chunk)}\n\n"
-        print(f"[DEBUG STREAM] Yielding chunk of type: {chunk.get('type', 'unknown')}")
+        formatted_chunk = format_sse_event(chunk)
+        logger.debug("[STREAM] Yielding chunk of type: %s", chunk.get("type", "unknown"))
         yield formatted_chunk
         
         # CRITICAL: After yielding a tool_end event, send any pending structured data
         # This ensures they appear in the stream right after the tool completion
         if isinstance(chunk, dict) and chunk.get("type") == "tool_end" and pending_structured_data:
-            print(f"[DEBUG CRITICAL DIRECT] Yielding {len(pending_structured_data)} pending structured data items after tool_end")
+            logger.debug("[DIRECT] Yielding %d pending structured data items after tool_end", len(pending_structured_data))
             
             # Small delay to ensure proper event ordering
             await asyncio.sleep(0.05)
             
             # Yield each pending structured data item as a separate event
             for data_item in pending_structured_data:
-                sd_formatted = f"data: {json.dumps(data_item)}\n\n"
-                print(f"[DEBUG CRITICAL DIRECT] Directly yielding structured_data event")
+                sd_formatted = format_sse_event(data_item)
                 yield sd_formatted
             
             # Clear the pending data
@@ -383,7 +417,7 @@ async def chat_stream(message: ChatMessage):
 async def get_conversation_history(request: ConversationHistoryRequest):
     """Get conversation history for a user"""
     try:
-        print("Fetching conversation history with params:", request)
+        logger.debug("Fetching conversation history with params: %s", request)
         
         # Filter by user_id if provided
         filtered_conversations = []
@@ -453,7 +487,7 @@ async def get_conversation_detail(conversation_id: str):
         # Re-raise HTTP exceptions
         raise he
     except Exception as e:
-        print(f"Error fetching conversation: {str(e)}")
+        logger.exception("Error fetching conversation: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/api/conversation/{conversation_id}")
@@ -473,7 +507,7 @@ async def delete_conversation(conversation_id: str):
         # Re-raise HTTP exceptions
         raise he
     except Exception as e:
-        print(f"Error deleting conversation: {str(e)}")
+        logger.exception("Error deleting conversation: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Run the FastAPI app with Uvicorn when the script is executed directly
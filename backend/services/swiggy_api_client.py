@@ -3,10 +3,14 @@ Client for interacting with Swiggy's API
 Provides unified access patterns, error handling, and caching
 """
 import asyncio
+import functools
+import logging
 import time
 import aiohttp
 from typing import Dict, List, Any, Optional, Tuple
 
+logger = logging.getLogger(__name__)
+
 class SwiggyAPIClient:
     """
     Client for interacting with Swiggy's API
@@ -25,6 +29,10 @@ class SwiggyAPIClient:
     _menu_cache = {}
     _search_cache = {}
     
+    # Requests currently in flight, keyed like the caches, so concurrent
+    # identical lookups (e.g. parallel tool calls) share a single API call
+    _inflight = {}
+    
     @classmethod
     async def get_restaurants(cls, latitude: float, longitude: float, page_type: str = "COLLECTION", 
                             use_cache: bool = True, cache_ttl: int = 300) -> Dict[str, Any]:
@@ -42,23 +50,8 @@ class SwiggyAPIClient:
             Restaurant data from API or cached data
         """
         cache_key = f"restaurants:{page_type}:{latitude}:{longitude}"
-        
-        # Try to get from cache if enabled
-        if use_cache and cache_key in cls._restaurant_cache:
-            timestamp, data = cls._restaurant_cache[cache_key]
-            if time.time() - timestamp < cache_ttl:
-                print(f"[DEBUG] Using cached restaurants for {page_type}")
-                return data
-        
-        # Fetch from API
         url = f"{cls.BASE_URL}/restaurants/list/v5?lat={latitude}&lng={longitude}&page_type={page_type}"
-        data = await cls._make_request(url)
-        
-        # Update cache if successful and caching is enabled
-        if use_cache and "error" not in data:
-            cls._restaurant_cache[cache_key] = (time.time(), data)
-        
-        return data
+        return await cls._cached_request(cls._restaurant_cache, cache_key, url, use_cache, cache_ttl)
     
     @classmethod
     async def search_restaurants(cls, query: str, latitude: float, longitude: float,
@@ -77,23 +70,8 @@ class SwiggyAPIClient:
             Search results from API or cached data
         """
         cache_key = f"search:{query}:{latitude}:{longitude}"
-        
-        # Try to get from cache if enabled
-        if use_cache and cache_key in cls._search_cache:
-            timestamp, data = cls._search_cache[cache_key]
-            if time.time() - timestamp < cache_ttl:
-                print(f"[DEBUG] Using cached search results for '{query}'")
-                return data
-        
-        # Fetch from API
         url = f"{cls.BASE_URL}/restaurants/search/v3?lat={latitude}&lng={longitude}&str={query}&trackingId=undefined"
-        data = await cls._make_request(url)
-        
-        # Update cache if successful and caching is enabled
-        if use_cache and "error" not in data:
-            cls._search_cache[cache_key] = (time.time(), data)
-            
-        return data
+        return await cls._cached_request(cls._search_cache, cache_key, url, use_cache, cache_ttl)
     
     @classmethod
     async def get_restaurant_menu(cls, restaurant_id: str, latitude: float, longitude: float,
@@ -112,23 +90,58 @@ class SwiggyAPIClient:
             Restaurant menu data from API or cached data
         """
         cache_key = f"menu:{restaurant_id}:{latitude}:{longitude}"
-        
-        # Try to get from cache if enabled
-        if use_cache and cache_key in cls._menu_cache:
-            timestamp, data = cls._menu_cache[cache_key]
-            if time.time() - timestamp < cache_ttl:
-                print(f"[DEBUG] Using cached menu for restaurant {restaurant_id}")
-                return data
-        
-        # Fetch from API
         url = f"{cls.BASE_URL}/menu/pl?page-type=REGULAR_MENU&complete-menu=true&lat={latitude}&lng={longitude}&submitAction=ENTER&restaurantId={restaurant_id}"
-        data = await cls._make_request(url)
+        return await cls._cached_request(cls._menu_cache, cache_key, url, use_cache, cache_ttl)
+    
+    @classmethod
+    async def _cached_request(cls, cache: Dict[str, Tuple[float, Dict[str, Any]]], cache_key: str,
+                              url: str, use_cache: bool, cache_ttl: int) -> Dict[str, Any]:
+        """
+        Serve a request from cache, join an identical in-flight request, or fetch it
         
-        # Update cache if successful and caching is enabled
-        if use_cache and "error" not in data:
-            cls._menu_cache[cache_key] = (time.time(), data)
+        Args:
+            cache: Cache dictionary for this endpoint
+            cache_key: Key identifying the request in cache and in-flight maps
+            url: Full API URL to request
+            use_cache: Whether to use caching
+            cache_ttl: Cache time-to-live in seconds
             
-        return data
+        Returns:
+            Response data from API or cached data
+        """
+        if not use_cache:
+            return await cls._make_request(url)
+        
+        # Try to get from cache
+        cached = cache.get(cache_key)
+        if cached is not None and time.time() - cached[0] < cache_ttl:
+            logger.debug("Using cached response for %s", cache_key)
+            return cached[1]
+        
+        # Join the request if another caller is already fetching it
+        task = cls._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(cls._make_request(url))
+            cls._inflight[cache_key] = task
+            task.add_done_callback(functools.partial(cls._store_result, cache, cache_key))
+        else:
+            logger.debug("Joining in-flight request for %s", cache_key)
+        
+        # Shield so one caller being cancelled doesn't cancel the shared request
+        return await asyncio.shield(task)
+    
+    @classmethod
+    def _store_result(cls, cache: Dict[str, Tuple[float, Dict[str, Any]]], cache_key: str,
+                      task: "asyncio.Future") -> None:
+        """Done-callback for a shared request: clear it from in-flight and cache successful data"""
+        cls._inflight.pop(cache_key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        
+        # Update cache if successful
+        data = task.result()
+        if "error" not in data:
+            cache[cache_key] = (time.time(), data)
         
     @classmethod
     async def _make_request(cls, url: str) -> Dict[str, Any]: